@@ -5,13 +5,27 @@
 
 
 import argparse
-import glob
-import itertools
+import asyncio
 import json
+import os
 import pathlib
 import shutil
+import sqlite3
+import struct
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from mediaUtils import (
+    findBox,
+    findMp3Frame,
+    findSoundTrack,
+    readEsds,
+    readId3Size,
+    readOggStream,
+    readTimescale,
+)
 
 
 def parseArgs():
@@ -46,6 +60,50 @@ def parseArgs():
         action="store_true",
         help=r"Only process a single file in a each directory.",
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=(
+            "Keep a manifest of probed files and bitrates, only added or modified "
+            "files are probed on later runs."
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        nargs="?",
+        default=1,
+        const=os.cpu_count(),
+        type=int,
+        help=(
+            "Number of concurrent ffprobe processes. "
+            "(default: 1, no value: CPU count)"
+        ),
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        default=rate // 1000,
+        type=int,
+        help=f"Bitrate threshold in kbps, default is {rate // 1000}",
+    )
+    parser.add_argument(
+        "-e",
+        "--reencode",
+        metavar="TARGET",
+        type=int,
+        help=(
+            "Re-encode files above the threshold to TARGET kbps with ffmpeg, "
+            "one process per CPU core."
+        ),
+    )
+    parser.add_argument(
+        "-f",
+        "--ffprobe-only",
+        action="store_true",
+        help="Always use ffprobe, skip the native MP3/M4A/Ogg header readers.",
+    )
 
     pargs = parser.parse_args()
 
@@ -65,9 +123,13 @@ def checkPaths(paths):
 
 rate = 68 * 1000 # in kbps # 86000
 
-ffprobePath = checkPaths({"ffprobe": r"C:\ffmpeg\bin\ffprobe.exe"})[0]
+ffprobePath, ffmpegPath = checkPaths(
+    {"ffprobe": r"C:\ffmpeg\bin\ffprobe.exe", "ffmpeg": r"C:\ffmpeg\bin\ffmpeg.exe"}
+)
+
+manifestCommitEvery = 500
 
-audioExts = (".m4a", ".m4b", ".mp3", ".opus", ".ogg", ".wma", ".mka")
+audioExts = {".m4a", ".m4b", ".mp3", ".opus", ".ogg", ".wma", ".mka"}
 
 getffprobeCmd = lambda ffprobePath, file: [
     ffprobePath,
@@ -82,18 +144,355 @@ getffprobeCmd = lambda ffprobePath, file: [
 ]
 
 
-getFileList = lambda dirPath: [
-    x for x in dirPath.iterdir() if x.is_file() and x.suffix.lower() in audioExts
+def getFileList(dirPath, rec=False, skip=False):
+    """
+    Single os.scandir walk filtered by audioExts, returns the matching files and
+    the number of skipped ones. With skip only the first matching file in each
+    directory is listed, without rec the rest of that directory isn't read.
+    Hidden files and directories such as macOS ._ files are left out like
+    glob does.
+    """
+    fileList, skipped, dirs = [], 0, [dirPath]
+    while dirs:
+        subDirs, found = [], False
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if rec and entry.is_dir(follow_symlinks=False):
+                    subDirs.append(entry.path)
+                elif (
+                    os.path.splitext(entry.name)[1].lower() in audioExts
+                    and entry.is_file()
+                ):
+                    if skip and found:
+                        skipped += 1
+                        continue
+                    fileList.append(pathlib.Path(entry.path))
+                    found = True
+                    if skip and not rec:
+                        break
+        dirs.extend(reversed(subDirs))
+    return fileList, skipped
+
+
+def getManifestPath():
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cacheHome, "PyUtils", "audioBitrateCheck.sqlite")
+
+
+def openManifest(manifestPath):
+    manifestPath.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(manifestPath)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS manifest (root TEXT, path TEXT, size INTEGER, "
+        "mtime_ns INTEGER, bit_rate TEXT, PRIMARY KEY (root, path))"
+    )
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)")
+    return con
+
+
+def getStoredBitRate(con, root, fileObj):
+    stat = fileObj.stat()
+    key = (root, str(fileObj), stat.st_size, stat.st_mtime_ns)
+    con.execute("INSERT OR IGNORE INTO seen VALUES (?)", (str(fileObj),))
+    row = con.execute(
+        "SELECT bit_rate FROM manifest "
+        "WHERE root = ? AND path = ? AND size = ? AND mtime_ns = ?",
+        key,
+    ).fetchone()
+    return key, (row[0] if row else None)
+
+
+def storeBitRate(con, key, bitRate):
+    con.execute(
+        "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?)", (*key, bitRate)
+    )
+
+
+def pruneManifest(con, root):
+    # Drops files that were removed since the last run, returns their count.
+    removed = con.execute(
+        "DELETE FROM manifest WHERE root = ? AND path NOT IN (SELECT path FROM seen)",
+        (root,),
+    ).rowcount
+    con.commit()
+    return removed
+
+
+getBitRate = lambda ffprobeOut: json.loads(ffprobeOut.decode("utf-8"))["streams"][0][
+    "bit_rate"
 ]
 
 
-getFileListRec = lambda dirPath: [
-    pathlib.Path(x)
-    for x in itertools.chain.from_iterable(
-        [glob.glob(f"{dirPath}/**/*{f}", recursive=True) for f in audioExts]
+def probeFiles(fileList, onDone):
+    probed = []
+    for fileObj in fileList:
+        try:
+            probed.append(
+                getBitRate(subprocess.check_output(getffprobeCmd(ffprobePath, fileObj)))
+            )
+        except Exception as err:
+            probed.append(err)
+        onDone(fileObj, probed[-1])
+    return probed
+
+
+async def probeFileAsync(fileObj):
+    ffprobeCmd = getffprobeCmd(ffprobePath, fileObj)
+    proc = await asyncio.create_subprocess_exec(
+        *ffprobeCmd, stdout=asyncio.subprocess.PIPE
     )
+    stdout, _ = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, ffprobeCmd, stdout)
+    return getBitRate(stdout)
+
+
+async def probeFilesAsync(fileList, jobs, onDone):
+    # The semaphore bounds both running ffprobe processes and pending tasks,
+    # results keep the order of fileList.
+    semaphore = asyncio.Semaphore(jobs)
+    probed = [None] * len(fileList)
+    tasks = set()
+
+    async def probe(i, fileObj):
+        try:
+            probed[i] = await probeFileAsync(fileObj)
+        except Exception as err:
+            probed[i] = err
+        finally:
+            semaphore.release()
+            onDone(fileObj, probed[i])
+
+    for i, fileObj in enumerate(fileList):
+        await semaphore.acquire()
+        task = asyncio.create_task(probe(i, fileObj))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    return probed
+
+
+def readMp3BitRate(fileObj):
+    # First frame after any ID3v2 tag; a Xing/Info or VBRI header in it gives
+    # the frame and byte counts of VBR files, otherwise the file is CBR.
+    with open(fileObj, "rb") as f:
+        _, start = readId3Size(f.read(10))
+        f.seek(start)
+        data = f.read(64 * 1024)
+
+    frame = findMp3Frame(data)
+    if not frame:
+        return None
+    pos, (bitRate, sampleRate, samples, _, sideInfo) = frame
+
+    frames = size = None
+    xing = pos + 4 + sideInfo
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        if data[xing : xing + 4] == b"Info":
+            return bitRate
+        flags = int.from_bytes(data[xing + 4 : xing + 8], "big")
+        offset = xing + 8
+        if flags & 1:
+            frames = int.from_bytes(data[offset : offset + 4], "big")
+            offset += 4
+        if flags & 2:
+            size = int.from_bytes(data[offset : offset + 4], "big")
+            offset += 4
+        offset += 100 if flags & 4 else 0
+        offset += 4 if flags & 8 else 0
+        if not frames and data[offset : offset + 4] == b"LAME":
+            # LAME tag: ABR bitrate or VBR minimal bitrate byte in kbps
+            return data[offset + 20] * 1000 or None
+    elif data[pos + 36 : pos + 40] == b"VBRI":
+        vbri = pos + 36
+        size = int.from_bytes(data[vbri + 10 : vbri + 14], "big")
+        frames = int.from_bytes(data[vbri + 14 : vbri + 18], "big")
+    else:
+        return bitRate
+
+    if not frames:
+        return None
+    if not size:
+        size = fileObj.stat().st_size - start - pos
+    return round(size * 8 * sampleRate / (frames * samples))
+
+
+def readMp4BitRate(fileObj):
+    # avgBitrate of the first sound track from its btrt or esds box, or the
+    # sample sizes from stsz over the mdhd duration when that is 0.
+    fileSize = fileObj.stat().st_size
+    with open(fileObj, "rb") as f:
+        moov = findBox(f, 0, fileSize, [b"moov"])
+        trak = moov and findSoundTrack(f, moov)
+        if not trak:
+            return None
+        mdia = findBox(f, *trak, [b"mdia"])
+        stbl = findBox(f, *mdia, [b"minf", b"stbl"])
+        stsd = findBox(f, *stbl, [b"stsd"])
+        f.seek(stsd[0] + 8)
+        entrySize, _ = struct.unpack(">I4s", f.read(8))
+        entryEnd = stsd[0] + 8 + entrySize
+        f.seek(stsd[0] + 8 + 16)
+        # QuickTime sound sample description versions 1 and 2 are longer
+        version = struct.unpack(">H", f.read(2))[0]
+        childStart = stsd[0] + 8 + 36 + {1: 16, 2: 36}.get(version, 0)
+
+        bitRate = None
+        for path in ([b"btrt"], [b"esds"], [b"wave", b"esds"]):
+            box = findBox(f, childStart, entryEnd, path)
+            if box and path[-1] == b"btrt":
+                f.seek(box[0])
+                bitRate = struct.unpack(">4xII", f.read(12))[1]
+            elif box:
+                esds = readEsds(f, box[0])
+                bitRate = esds and esds[1]
+            if bitRate:
+                return bitRate
+
+        mdhd = findBox(f, *mdia, [b"mdhd"])
+        timescale, duration = readTimescale(f, mdhd[0])
+        stsz = findBox(f, *stbl, [b"stsz"])
+        f.seek(stsz[0] + 4)
+        sampleSize, count = struct.unpack(">II", f.read(8))
+        if sampleSize:
+            dataSize = sampleSize * count
+        else:
+            dataSize = sum(struct.unpack(f">{count}I", f.read(count * 4)))
+        if duration:
+            return round(dataSize * 8 * timescale / duration)
+        return None
+
+
+def readOggBitRate(fileObj):
+    # Vorbis: nominal bitrate of the identification header. Opus (and Vorbis
+    # without a nominal bitrate): file size over the duration from the last
+    # page's granule position.
+    fileSize = fileObj.stat().st_size
+    with open(fileObj, "rb") as f:
+        stream = readOggStream(f, fileSize)
+    if not stream:
+        return None
+    sampleRate, nominal, samples = stream
+    if nominal > 0:
+        return nominal
+    return round(fileSize * 8 * sampleRate / samples) if samples else None
+
+
+nativeReaders = {
+    ".mp3": readMp3BitRate,
+    ".m4a": readMp4BitRate,
+    ".m4b": readMp4BitRate,
+    ".ogg": readOggBitRate,
+    ".opus": readOggBitRate,
+}
+
+
+def readBitRate(fileObj):
+    """
+    Read the audio bitrate without ffprobe, returns None for unsupported or
+    unreadable files so they can fall back to ffprobe.
+    """
+    reader = nativeReaders.get(fileObj.suffix.lower())
+    if not reader:
+        return None
+    try:
+        bitRate = reader(fileObj)
+    except (OSError, ValueError, IndexError, TypeError, struct.error):
+        return None
+    return str(bitRate) if bitRate else None
+
+
+# (encoder, muxer), the muxer is passed explicitly since the temp output
+# doesn't have an audio extension
+encoders = {
+    ".m4a": ("aac", "ipod"),
+    ".m4b": ("aac", "ipod"),
+    ".mp3": ("libmp3lame", "mp3"),
+    ".opus": ("libopus", "opus"),
+    ".ogg": ("libvorbis", "ogg"),
+    ".wma": ("wmav2", "asf"),
+    ".mka": ("libopus", "matroska"),
+}
+
+getffmpegCmd = lambda ffmpegPath, fileObj, outFile, target: [
+    ffmpegPath,
+    "-nostdin",
+    "-i",
+    str(fileObj),
+    "-map",
+    "0",
+    "-map_metadata",
+    "0",
+    "-c",
+    "copy",
+    "-c:a",
+    encoders[fileObj.suffix.lower()][0],
+    "-b:a",
+    f"{target}k",
+    "-loglevel",
+    "warning",
+    "-f",
+    encoders[fileObj.suffix.lower()][1],
+    "-y",
+    str(outFile),
 ]
 
+
+def reencode(fileObj, target):
+    # Encode to a hidden temp file next to the source and swap it in with
+    # os.replace, the original is kept if the result isn't smaller. The .tmp
+    # suffix keeps a leftover from a crashed run out of the next scan.
+    tmpFile = fileObj.with_name(f".{fileObj.name}.reencode.tmp")
+    start = time.perf_counter()
+    try:
+        subprocess.run(
+            getffmpegCmd(ffmpegPath, fileObj, tmpFile, target),
+            check=True,
+            capture_output=True,
+            stdin=subprocess.DEVNULL,  # the pool runs one ffmpeg per core
+        )
+        oldSize, newSize = fileObj.stat().st_size, tmpFile.stat().st_size
+        if newSize < oldSize:
+            os.replace(tmpFile, fileObj)
+        else:
+            tmpFile.unlink()
+            newSize = oldSize
+    except BaseException:
+        tmpFile.unlink(missing_ok=True)
+        raise
+    return oldSize - newSize, time.perf_counter() - start
+
+
+def reencodeFiles(fileList, target):
+    saved, encodeTime, failed = 0, 0.0, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {executor.submit(reencode, f, target): f for f in fileList}
+        for i, future in enumerate(as_completed(futures), 1):
+            fileObj = futures[future]
+            try:
+                fileSaved, fileTime = future.result()
+                saved += fileSaved
+                encodeTime += fileTime
+                print(f"\nRe-encoded ({i}/{len(fileList)}): {str(fileObj)}")
+            except Exception as err:
+                failed += 1
+                stderr = getattr(err, "stderr", b"") or b""
+                print(
+                    f"\nERROR: While re-encoding {str(fileObj)}\n\n{str(err)}\n"
+                    f"{stderr.decode('utf-8', 'replace')}"
+                )
+
+    print(
+        f"\nRe-encoded files: {len(fileList) - failed}; Failed files: {failed};"
+        f"\nSaved: {saved} bytes ({round(saved / (1 << 20), 2)} MB);"
+        f"\nEncoding time: {round(encodeTime, 2)} seconds; "
+        f"Elapsed time: {round(time.perf_counter() - start, 2)} seconds;"
+    )
+
+
 resultsList = []
 
 bitRates = {}
@@ -129,46 +528,98 @@ def main(pargs):
 
     dirPath = pargs.dir.resolve()
 
-    if pargs.recursive:
-        fileList = getFileListRec(dirPath)
-    else:
-        fileList = getFileList(dirPath)
+    fileList, skipped = getFileList(dirPath, pargs.recursive, pargs.skip)
 
     if not fileList:
         print("Nothing to do.")
         sys.exit()
 
-    prevParent = ""
-    skipped = 0
-    processed = 0
-    for fileObj in fileList:
+    if pargs.incremental:
+        manifestCon = openManifest(getManifestPath())
 
-        if pargs.skip and prevParent and fileObj.parent == prevParent:
-            skipped += 1
-            continue
+    processed = 0
 
-        prevParent = fileObj.parent
+    def showProgress():
+        nonlocal processed
         processed += 1
-
         print(
-            f"Processed files: {processed}; Skipped files: {skipped}; Total files: {len(fileList)};",
+            f"Processed files: {processed}; Skipped files: {skipped}; Total files: {len(fileList) + skipped};",
             end="\r",
         )
 
-        ffprobeCmd = getffprobeCmd(ffprobePath, fileObj)
+    fileBitRates = dict.fromkeys(fileList)
+    newBitRates = 0
+
+    def onBitRate(fileObj, bitRate):
+        # New bitrates go into the manifest as they come in and are committed
+        # in batches, an interrupted run keeps what it already read.
+        nonlocal newBitRates
+        if not bitRate:
+            return
+        if pargs.incremental and not isinstance(bitRate, Exception):
+            storeBitRate(manifestCon, manifestKeys[fileObj], bitRate)
+            newBitRates += 1
+            if newBitRates % manifestCommitEvery == 0:
+                manifestCon.commit()
+        showProgress()
+
+    if pargs.incremental:
+        manifestKeys = {}
+        for fileObj in fileList:
+            try:
+                manifestKeys[fileObj], fileBitRates[fileObj] = getStoredBitRate(
+                    manifestCon, str(dirPath), fileObj
+                )
+            except OSError as err:
+                fileBitRates[fileObj] = err
+            if fileBitRates[fileObj]:
+                showProgress()
+
+    stored = sum(1 for bitRate in fileBitRates.values() if bitRate)
+
+    if not pargs.ffprobe_only:
+        for fileObj, bitRate in fileBitRates.items():
+            if not bitRate:
+                fileBitRates[fileObj] = readBitRate(fileObj)
+                onBitRate(fileObj, fileBitRates[fileObj])
+
+    toProbe = [fileObj for fileObj, bitRate in fileBitRates.items() if not bitRate]
+
+    if pargs.jobs > 1:
+        probed = asyncio.run(probeFilesAsync(toProbe, pargs.jobs, onBitRate))
+    else:
+        probed = probeFiles(toProbe, onBitRate)
 
+    fileBitRates.update(zip(toProbe, probed))
+
+    threshold = pargs.threshold * 1000
+    flagged = []
+
+    for fileObj, bitRate in fileBitRates.items():
         try:
-            bitRate = json.loads(subprocess.check_output(ffprobeCmd).decode("utf-8"))[
-                "streams"
-            ][0]["bit_rate"]
+            if isinstance(bitRate, Exception):
+                raise bitRate
 
-            if int(bitRate) > rate:
+            if int(bitRate) > threshold:
                 results(fileObj, bitRate)
+                if pargs.reencode and int(bitRate) > pargs.reencode * 1000:
+                    flagged.append(fileObj)
 
         except Exception as err:
             print(f"\nERROR: While processing {str(fileObj)}\n\n{str(err)}\n")
 
     printList(resultsList, bitRates)
 
+    if pargs.incremental:
+        removed = pruneManifest(manifestCon, str(dirPath))
+        manifestCon.close()
+        print(
+            f"\nUnchanged files: {stored}; Probed files: {processed - stored}; "
+            f"Removed files: {removed};"
+        )
+
+    if flagged:
+        reencodeFiles(flagged, pargs.reencode)
+
 
 main(parseArgs())
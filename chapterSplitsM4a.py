@@ -12,11 +12,16 @@ import os
 import os.path as path
 import pathlib
 import re
+import struct
 import subprocess
 import sys
 import time
-import unicodedata
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+from journalUtils import addJournal, closeJournal, isFinished, loadJournal, openJournal
+from mediaUtils import findBox, iterBoxes, readTags, readTimescale
+from slugifyUtils import slugify as slugifyName
 
 
 def parseArgs():
@@ -52,6 +57,45 @@ def parseArgs():
         help="Do not write anything to Disk(except logs) / Dry run.",
         action="store_true",
     )
+    parser.add_argument(
+        "-o",
+        "--one-pass",
+        action="store_true",
+        help=(
+            "Split all chapters with a single ffmpeg run per file (up to "
+            f"{chaptersPerPass} chapters per run) instead of one run per chapter."
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help=(
+            "Process all files without prompts or waits, output is only written "
+            "to the logs."
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        nargs="?",
+        default=1,
+        const=os.cpu_count(),
+        type=int,
+        help=(
+            "Number of files processed concurrently by --batch. "
+            "(default: 1, no value: CPU count)"
+        ),
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help=(
+            "Skip chapters recorded as finished in logs/journal.jsonl by "
+            "a previous run."
+        ),
+    )
     parser.add_argument(
         "-w",
         "--wait",
@@ -71,8 +115,7 @@ secondsToHMS = lambda sec: str(DT.timedelta(seconds=sec))
 
 def makeTargetDirs(name, dirPath):
     newPath = dirPath.joinpath(name)
-    if not newPath.exists():
-        os.mkdir(newPath)
+    os.makedirs(newPath, exist_ok=True)
     return newPath
 
 
@@ -80,8 +123,9 @@ def nSort(s, _nsre=re.compile("([0-9]+)")):
     return [int(text) if text.isdigit() else text.lower() for text in _nsre.split(s)]
 
 
-def printLog(data, logRef):
-    print(data)
+def printLog(data, logRef, quiet=False):
+    if not quiet:
+        print(data)
     logRef.write(data)
 
 
@@ -104,31 +148,13 @@ def wait(sec):
     time.sleep(int(sec))
 
 
-def slugify(value, replace={}, keepSpace=True):
-    """
-    Adapted from django.utils.text.slugify
-    https://docs.djangoproject.com/en/3.0/_modules/django/utils/text/#slugify
-    """
-    replace.update({"[": "(", "]": ")", ":": "_", "()": ""})
-    value = str(value)
-    value = (
-        unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
-    )
-
-    for k, v in replace.items():
-        value = value.replace(k, v)
-    value = re.sub(r"[^\w\s)(_-]", "", value).strip()
-
-    if keepSpace:
-        value = re.sub(r"[\s]+", " ", value)
-    else:
-        value = re.sub(r"[-\s]+", "-", value)
-    return value
-
-
-getFileList = lambda dirPath: [
-    x for x in dirPath.iterdir() if x.is_file() and ".info.json" in x.name
-]
+slugify = fn.partial(
+    slugifyName,
+    replace=False,
+    keepDots=False,
+    collapseSpace=True,
+    swap={":": "_", "()": ""},
+)
 
 
 def HMSToMS(time):
@@ -145,27 +171,212 @@ def getJson(file):
         return json.loads(f.read())
 
 
-pargs = parseArgs()
+mp4Exts = {".m4a", ".m4b"}
+
+def getFileList(dirPath):
+    # info.json files plus m4a/m4b files without one, chapters of the latter
+    # are read from the file itself.
+    files = [x for x in dirPath.iterdir() if x.is_file()]
+    infoNames = {
+        x.name.replace(".info.json", "") for x in files if ".info.json" in x.name
+    }
+    return [
+        x
+        for x in files
+        if ".info.json" in x.name
+        or (x.suffix.lower() in mp4Exts and x.stem not in infoNames)
+    ]
+
+
+def readTable(f, box, fmt):
+    f.seek(box[0] + 4)
+    count = struct.unpack(">I", f.read(4))[0]
+    return list(struct.iter_unpack(fmt, f.read(count * struct.calcsize(fmt))))
+
+
+def readChpl(f, chpl, duration):
+    # Nero chapters, start times are in 100ns units
+    f.seek(chpl[0])
+    if f.read(4)[0] == 1:
+        f.read(4)
+    starts, titles = [], []
+    for _ in range(f.read(1)[0]):
+        starts.append(struct.unpack(">Q", f.read(8))[0] / 10_000_000)
+        titles.append(f.read(f.read(1)[0]).decode("utf-8", "replace"))
+    ends = starts[1:] + [duration]
+    return [
+        {"start_time": s, "end_time": e, "title": t}
+        for s, e, t in zip(starts, ends, titles)
+    ]
+
+
+def readTextTrack(f, trak):
+    # QuickTime chapter track, each sample is a 16 bit length and the title
+    timescale = readTimescale(f, findBox(f, *trak, [b"mdia", b"mdhd"])[0])[0]
+    stbl = findBox(f, *trak, [b"mdia", b"minf", b"stbl"])
+    boxes = {boxType: (start, end) for boxType, start, end in iterBoxes(f, *stbl)}
+
+    f.seek(boxes[b"stsz"][0] + 4)
+    sampleSize, sampleCount = struct.unpack(">II", f.read(8))
+    if sampleSize:
+        sizes = [sampleSize] * sampleCount
+    else:
+        sizes = [s for s, in struct.iter_unpack(">I", f.read(sampleCount * 4))]
 
-dirPath = pargs.dir.resolve()
+    if b"co64" in boxes:
+        chunkOffsets = [o for o, in readTable(f, boxes[b"co64"], ">Q")]
+    else:
+        chunkOffsets = [o for o, in readTable(f, boxes[b"stco"], ">I")]
+
+    stsc = readTable(f, boxes[b"stsc"], ">III")
+    offsets = []
+    for i, (firstChunk, perChunk, _) in enumerate(stsc):
+        lastChunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunkOffsets)
+        for chunk in range(firstChunk, lastChunk + 1):
+            offset = chunkOffsets[chunk - 1]
+            for _ in range(perChunk):
+                if len(offsets) == sampleCount:
+                    break
+                offsets.append(offset)
+                offset += sizes[len(offsets) - 1]
+
+    chapters = []
+    time = 0
+    stts = readTable(f, boxes[b"stts"], ">II")
+    durations = (duration for count, duration in stts for _ in range(count))
+    for offset, duration in zip(offsets, durations):
+        f.seek(offset)
+        text = f.read(struct.unpack(">H", f.read(2))[0])
+        if text.startswith(b"\xfe\xff"):
+            title = text.decode("utf-16")
+        else:
+            title = text.decode("utf-8", "replace")
+        chapters.append(
+            {
+                "start_time": time / timescale,
+                "end_time": (time + duration) / timescale,
+                "title": title,
+            }
+        )
+        time += duration
+    return chapters
+
+
+def readMp4Chapters(m4aFile):
+    """
+    Read chapters from a Nero chpl box or a QuickTime chapter text track and
+    the title/artist tags without ffprobe, returns an info.json like dict.
+    """
+    fileSize = m4aFile.stat().st_size
+    with open(m4aFile, "rb") as f:
+        moov = findBox(f, 0, fileSize, [b"moov"])
+        if not moov:
+            raise ValueError("moov box not found")
+
+        duration = chpl = None
+        tags = {}
+        tracks = {}
+        chapterIds = []
+        for boxType, start, end in iterBoxes(f, *moov):
+            if boxType == b"mvhd":
+                timescale, duration = readTimescale(f, start)
+                duration /= timescale
+            elif boxType == b"udta":
+                chpl = findBox(f, start, end, [b"chpl"])
+                meta = findBox(f, start, end, [b"meta"])
+                tags = readTags(f, meta) if meta else tags
+            elif boxType == b"trak":
+                tkhd = findBox(f, start, end, [b"tkhd"])
+                f.seek(tkhd[0])
+                version = f.read(4)[0]
+                f.read(16 if version == 1 else 8)
+                tracks[struct.unpack(">I", f.read(4))[0]] = (start, end)
+                chap = findBox(f, start, end, [b"tref", b"chap"])
+                if chap:
+                    f.seek(chap[0])
+                    chapterIds += struct.unpack(
+                        f">{(chap[1] - chap[0]) // 4}I", f.read(chap[1] - chap[0])
+                    )
+
+        chapters = None
+        if chpl:
+            chapters = readChpl(f, chpl, duration)
+        for trackId in chapterIds:
+            if not chapters and trackId in tracks:
+                chapters = readTextTrack(f, tracks[trackId])
+
+    return {
+        "chapters": chapters or None,
+        "creator": tags.get("album_artist") or tags.get("artist"),
+        "uploader": "Unknown",
+        "title": tags.get("album") or tags.get("title") or m4aFile.stem,
+    }
+
+
+chaptersPerPass = 50  # keeps the command line short enough for Windows
+
+getMetadataArgs = lambda track, title, artist, album: [
+    "-metadata",
+    f"track={track}",
+    "-metadata",
+    f"title={title}",
+    "-metadata",
+    f"artist={artist}",
+    "-metadata",
+    f"album_artist={artist}",
+    "-metadata",
+    f"album={album}",
+]
 
-fileList = sorted(getFileList(dirPath), key=lambda k: nSort(str(k.stem)))
 
-if not fileList:
-    print("Nothing to do.")
-    sys.exit()
+def getOnePassCmd(m4aFile, outputs):
+    # The input -ss seeks to the batch's first chapter so later batches don't
+    # demux everything before them, the input timestamps then start at 0 so
+    # the output side -ss/-to of every chapter are relative to it.
+    batchStart = outputs[0][0]
+    cmd = ["ffmpeg", "-nostdin", "-n", "-loglevel", "warning"]
+    cmd.extend(["-ss", secondsToHMS(batchStart), "-i", m4aFile])
+    for start, end, metadataArgs, outFile in outputs:
+        cmd.extend(["-ss", secondsToHMS(start - batchStart)])
+        cmd.extend(["-to", secondsToHMS(end - batchStart), "-c:a", "copy"])
+        cmd.extend(metadataArgs)
+        cmd.append(outFile)
+    return cmd
 
-for file in fileList:
 
-    baseName = str(file.name).replace(".info.json", "")
+def runFfmpeg(cmd):
+    # ffmpeg's output is captured for the logs, so it gets no terminal to prompt
+    # on, with -n an existing output fails instead of asking to overwrite it.
+    return subprocess.check_output(
+        cmd, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT
+    ).decode("utf-8")
 
-    m4aFile = dirPath.joinpath(f"{baseName}.m4a")
 
-    if not m4aFile.exists():
-        print(f"\n\n\nNo matching m4a file found for {file}")
-        continue
+def splitBook(file, quiet=False):
+    """
+    Split or generate a cue sheet for a single info.json/m4a pair or a m4a/m4b
+    file with embedded chapters, returns False if it was skipped.
+    """
+    if file.suffix.lower() in mp4Exts:
+        baseName = file.stem
+        m4aFile = file
+        try:
+            js = readMp4Chapters(file)
+        except (OSError, ValueError, IndexError, KeyError, TypeError, struct.error):
+            if not quiet:
+                print(f"\n\n\nFailed to read chapters from {file}")
+            return False
+    else:
+        baseName = str(file.name).replace(".info.json", "")
+
+        m4aFile = dirPath.joinpath(f"{baseName}.m4a")
+
+        if not m4aFile.exists():
+            if not quiet:
+                print(f"\n\n\nNo matching m4a file found for {file}")
+            return False
 
-    js = getJson(file)
+        js = getJson(file)
 
     if pargs.fn_tags:
         tagName = baseName.rsplit("-", 1)[0].strip()
@@ -177,15 +388,24 @@ for file in fileList:
 
     logsDir = makeTargetDirs("logs", dirPath)
 
-    log = open(logsDir.joinpath(f"{baseName}.log"), "w")
+    with open(logsDir.joinpath(f"{baseName}.log"), "w") as log:
+        return splitChapters(
+            fn.partial(printLog, logRef=log, quiet=quiet),
+            js,
+            baseName,
+            m4aFile,
+            artist,
+            album,
+        )
 
-    printLogP = fn.partial(printLog, logRef=log)
+
+def splitChapters(printLogP, js, baseName, m4aFile, artist, album):
     printLogP("\n\n==============================")
     printLogP(f"\n\nProcessing {album}")
 
     if not isinstance(js["chapters"], Iterable):
         printLogP(f"\n\n\nSkipping {album}, Chapters info not found.")
-        continue
+        return False
 
     if not pargs.no_write:
         if pargs.gen_cue:
@@ -199,6 +419,8 @@ for file in fileList:
             extractDir = makeTargetDirs(album, artistDir)
             printLogP(f"\nOutput directory name: {extractDir}")
 
+    outputs = []
+
     for i, chapter in enumerate(js["chapters"]):
         startTime = secondsToHMS(chapter["start_time"])
         endTime = secondsToHMS(chapter["end_time"])
@@ -217,9 +439,26 @@ for file in fileList:
                 f.write(f"\n    INDEX 01 {HMSToMS(startTime)}:00 ")
         else:
             printLogP(f"\nOutput file name: {fileName}")
-            out = subprocess.check_output(
+            outFile = path.join(extractDir, fileName)
+            if pargs.resume and isFinished(finished, outFile):
+                printLogP("\nAlready finished, skipping.")
+                continue
+            metadataArgs = getMetadataArgs(track, title, artist, album)
+            if pargs.one_pass:
+                outputs.append(
+                    (
+                        float(chapter["start_time"]),
+                        float(chapter["end_time"]),
+                        metadataArgs,
+                        outFile,
+                    )
+                )
+                continue
+            out = runFfmpeg(
                 [
                     "ffmpeg",
+                    "-nostdin",
+                    "-n",
                     "-ss",
                     startTime,
                     "-to",
@@ -228,27 +467,78 @@ for file in fileList:
                     m4aFile,
                     "-c:a",
                     "copy",
-                    "-metadata",
-                    f"track={track}",
-                    "-metadata",
-                    f"title={title}",
-                    "-metadata",
-                    f"artist={artist}",
-                    "-metadata",
-                    f"album_artist={artist}",
-                    "-metadata",
-                    f"album={album}",
+                    *metadataArgs,
                     "-loglevel",
                     "warning",
-                    path.join(extractDir, fileName),
+                    outFile,
                 ]
-            ).decode("utf-8")
+            )
             printLogP(out)
+            addJournal(journal, outFile)
+
+    for i in range(0, len(outputs), chaptersPerPass):
+        batch = outputs[i : i + chaptersPerPass]
+        printLogP(f"\n\nSplitting chapters {i + 1} to {i + len(batch)}")
+        out = runFfmpeg(getOnePassCmd(m4aFile, batch))
+        printLogP(out)
+        for *_, outFile in batch:
+            addJournal(journal, outFile)
+
+    return True
+
+
+def printFailed(file, err):
+    output = getattr(err, "output", b"") or b""
+    print(f"\nFailed: {file.name}\n{err}\n{output.decode('utf-8')}")
+
+
+def runBatchBook(file):
+    try:
+        return splitBook(file, quiet=True)
+    except Exception as err:
+        return err
+
+
+pargs = parseArgs()
+
+dirPath = pargs.dir.resolve()
+
+fileList = sorted(getFileList(dirPath), key=lambda k: nSort(str(k.stem)))
+
+if not fileList:
+    print("Nothing to do.")
+    sys.exit()
+
+journalPath = makeTargetDirs("logs", dirPath).joinpath("journal.jsonl")
+
+# without --resume existing outputs are left alone and their chapters fail
+finished = loadJournal(journalPath) if pargs.resume else None
+
+journal = openJournal(journalPath)
+
+if pargs.batch:
+    with ThreadPoolExecutor(max_workers=pargs.jobs) as executor:
+        for file, result in zip(fileList, executor.map(runBatchBook, fileList)):
+            if isinstance(result, Exception):
+                printFailed(file, result)
+            else:
+                print(f"\n{'Done' if result else 'Skipped'}: {file.name}")
+    closeJournal(journal)
+    sys.exit()
+
+for file in fileList:
+
+    try:
+        if not splitBook(file):
+            continue
+    except subprocess.CalledProcessError as err:
+        printFailed(file, err)
 
-    log.close()
     if pargs.wait:
         wait(pargs.wait)
     else:
         choice = getInput()
         if choice == "e":
             break
+
+closeJournal(journal)
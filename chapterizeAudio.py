@@ -1,13 +1,30 @@
 import argparse
+import functools as fn
+import io
 import json
-import math
 import os
 import pathlib
 import re
 import shutil
+import struct
 import subprocess
 import sys
-import unicodedata
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fractions import Fraction
+
+from journalUtils import addJournal, closeJournal, isFinished, loadJournal, openJournal
+from mediaUtils import (
+    findBox,
+    findSoundTrack,
+    readId3Size,
+    readMp3Stream,
+    readTags,
+    readTimescale,
+)
+from slugifyUtils import slugify as slugifyName
 
 
 def parseArgs():
@@ -42,6 +59,41 @@ def parseArgs():
         type=int,
         help="Maximum split size in MB for multi-part file, default is 150 MB",
     )
+    parser.add_argument(
+        "-p",
+        "--pack-by",
+        choices=["size", "duration"],
+        default="size",
+        help="Balance split parts by size or duration, default is size",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of files probed or transcoded concurrently, default is CPU count",
+    )
+    parser.add_argument(
+        "-m",
+        "--mux-jobs",
+        nargs="?",
+        default=1,
+        const=os.cpu_count(),
+        type=int,
+        help=(
+            "Number of split parts muxed concurrently. "
+            "(default: 1, no value: CPU count)"
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--normalize",
+        action="store_true",
+        help=(
+            "Transcode tracks whose codec, sample rate or channels differ from "
+            "the most common ones before merging."
+        ),
+    )
     parser.add_argument(
         "-i",
         "--ignore-tags",
@@ -51,26 +103,9 @@ def parseArgs():
     return parser.parse_args()
 
 
-def slugify(value, replace={}, keepSpace=True):
-    """
-    Adapted from django.utils.text.slugify
-    https://docs.djangoproject.com/en/3.0/_modules/django/utils/text/#slugify
-    """
-    replace.update({"[": "(", "]": ")", ":": "_"})
-    value = str(value)
-    value = (
-        unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
-    )
-
-    for k, v in replace.items():
-        value = value.replace(k, v)
-    value = re.sub(r"[^\w\s)(_-]", "", value).strip()
-
-    if keepSpace:
-        value = re.sub(r"[\s]+", " ", value)
-    else:
-        value = re.sub(r"[-\s]+", "-", value)
-    return value
+slugify = fn.partial(
+    slugifyName, replace=False, keepDots=False, collapseSpace=True, swap={":": "_"}
+)
 
 
 def nSort(s, _nsre=re.compile("([0-9]+)")):
@@ -124,12 +159,16 @@ getffprobeCmd = lambda ffprobePath, file: [
 
 getffmpegCmd = lambda ffmpegPath, ccFile, chFile, outFile: [
     ffmpegPath,
+    "-protocol_whitelist",
+    "file,pipe",
     "-f",
     "concat",
     "-safe",
     "0",
     "-i",
     str(ccFile),
+    "-f",
+    "ffmetadata",
     "-i",
     str(chFile),
     "-map_metadata",
@@ -142,40 +181,237 @@ getffmpegCmd = lambda ffmpegPath, ccFile, chFile, outFile: [
 ]
 
 
-def getSize(totalSize, maxSplit):
-    fSize = 0
-    for i in range(2, 15):
-        splitSize = math.ceil(totalSize / i)
-        if totalSize <= splitSize:
-            continue
-        if splitSize <= maxSplit:
-            fSize = splitSize
-            return i, splitSize
-    if fSize == 0:
-        return 1, totalSize
+def getPartCuts(sizes, weights, maxSize, maxWeight):
+    # Greedy fill in track order, a track bigger than maxSize gets a part to
+    # itself. Returns (start, end) indices of each part.
+    cuts, start, size, weight = [], 0, 0, 0
+    for i, (fileSize, fileWeight) in enumerate(zip(sizes, weights)):
+        if i > start and (size + fileSize > maxSize or weight + fileWeight > maxWeight):
+            cuts.append((start, i))
+            start, size, weight = i, 0, 0
+        size += fileSize
+        weight += fileWeight
+    cuts.append((start, len(sizes)))
+    return cuts
 
 
-bytesToMB = lambda bytes: math.ceil(bytes / float(1 << 20))
+def packParts(sizes, weights, maxSize):
+    """
+    Linear partition of the tracks into as few parts as fit in maxSize bytes,
+    with the largest part by weight (size or duration) as small as possible.
+    Binary search over the part weight with an O(n) greedy check, O(n log S).
+    """
+    partCount = len(getPartCuts(sizes, weights, maxSize, sum(weights)))
+    low, high = max(weights), sum(weights)
+    while low < high:
+        mid = (low + high) // 2
+        if len(getPartCuts(sizes, weights, maxSize, mid)) <= partCount:
+            high = mid
+        else:
+            low = mid + 1
+    return getPartCuts(sizes, weights, maxSize, low)
 
 
-def getFileSizes(fileList):
-    totalSize = 0
-    for file in fileList:
-        totalSize += file.stat().st_size
-    return totalSize
+encoders = {"aac": ("aac", ".m4a"), "mp3": ("libmp3lame", ".mp3")}
+
+getAudioParams = lambda metaData: (
+    metaData["streams"][0].get("codec_name"),
+    int(metaData["streams"][0].get("sample_rate", 0)),
+    int(metaData["streams"][0].get("channels", 0)),
+)
+
+getNormalizeCmd = lambda ffmpegPath, file, params, outFile: [
+    ffmpegPath,
+    "-i",
+    str(file),
+    "-map",
+    "0:a:0",
+    "-c:a",
+    encoders[params[0]][0],
+    "-ar",
+    str(params[1]),
+    "-ac",
+    str(params[2]),
+    "-loglevel",
+    "warning",
+    str(outFile),
+]
+
+
+def getTargetParams(fileList, metaData):
+    # most common codec/sample rate/channels among the tracks, aac at that
+    # rate if none of the common ones can be encoded
+    counts = Counter(getAudioParams(metaData[f.name]) for f in fileList)
+    for params, _ in counts.most_common():
+        if params[0] in encoders:
+            return params
+    return ("aac", *counts.most_common(1)[0][0][1:])
+
+
+def normalizeFiles(ffmpegPath, fileList, params, tmpDir, jobs):
+    """
+    Transcode the tracks that don't match params into tmpDir concurrently so
+    the concat demuxer can stream copy all of them. Returns {input: normalized
+    file} or None if a transcode failed.
+    """
+    outFiles = [
+        tmpDir.joinpath(f"{i}{encoders[params[0]][1]}") for i in range(len(fileList))
+    ]
+    runNormalize = lambda job: subprocess.run(
+        getNormalizeCmd(ffmpegPath, *job), stdin=subprocess.DEVNULL
+    ).returncode
+    jobList = [(f, params, outFile) for f, outFile in zip(fileList, outFiles)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if any(executor.map(runNormalize, jobList)):
+            return None
+    return dict(zip(fileList, outFiles))
+
+
+getDurationMs = lambda metaData: round(
+    int(metaData["streams"][0]["duration_ts"])
+    * Fraction(metaData["streams"][0]["time_base"])
+    * 1000
+)
+
+
+id3Tags = {
+    b"TIT2": "title",
+    b"TPE1": "artist",
+    b"TPE2": "album_artist",
+    b"TALB": "album",
+}
+
+id3Encodings = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+mp3Codecs = {1: "mp3", 2: "mp2", 3: "mp1"}
+
+mp4Codecs = {b"mp4a": "aac", b"alac": "alac", b"ac-3": "ac3", b"Opus": "opus"}
+
+
+def readId3Tags(data):
+    # ID3v2.3/2.4 text frames, None for tags that need ffprobe (v2.2,
+    # unsynchronisation, extended headers or encoded frames)
+    version, flags = data[3], data[5]
+    if version not in (3, 4) or flags & 0xC0:
+        return None
+    tags = {}
+    pos = 10
+    while pos + 10 <= len(data) and data[pos] != 0:
+        frameId = data[pos : pos + 4]
+        size = int.from_bytes(data[pos + 4 : pos + 8], "big")
+        if version == 4:  # syncsafe
+            b = data[pos + 4 : pos + 8]
+            size = b[0] << 21 | b[1] << 14 | b[2] << 7 | b[3]
+        frame = data[pos + 10 : pos + 10 + size]
+        if frameId in id3Tags and frame:
+            if data[pos + 9] & (0x0F if version == 4 else 0xC0):
+                return None
+            text = frame[1:].decode(id3Encodings[frame[0]], "replace")
+            tags[id3Tags[frameId]] = text.split("\x00")[0]
+        pos += 10 + size
+    return tags
+
+
+def readMp3Meta(file):
+    """
+    Duration from the frame count of a Xing/Info or VBRI header, or the audio
+    size over the bitrate for CBR files, and the ID3v2 tags.
+    """
+    fileSize = file.stat().st_size
+    with open(file, "rb") as f:
+        data = f.read(10)
+        tagEnd, start = readId3Size(data)
+        tags = readId3Tags(data + f.read(tagEnd - 10)) if tagEnd else {}
+        if tags is None:
+            return None
+        stream = readMp3Stream(f, start, fileSize)
+    if not stream:
+        return None
+    header, sampleRate, duration = stream
+
+    return {
+        "format": {"tags": tags},
+        "streams": [
+            {
+                "codec_name": mp3Codecs[(header[1] >> 1) & 3],
+                "sample_rate": str(sampleRate),
+                "channels": 1 if header[3] >> 6 == 3 else 2,
+                "time_base": f"1/{sampleRate}",
+                "duration_ts": duration,
+            }
+        ],
+    }
+
+
+stsdPath = [b"mdia", b"minf", b"stbl", b"stsd"]
+
+
+def readMp4Meta(file):
+    # codec, channels and sample rate from the stsd sample entry, mdhd timescale
+    # and duration of the first sound track and the ilst tags
+    fileSize = file.stat().st_size
+    with open(file, "rb") as f:
+        moov = findBox(f, 0, fileSize, [b"moov"])
+        if not moov:
+            raise ValueError("moov box not found")
+        trak = findSoundTrack(f, moov)
+        if not trak:
+            return None
+        meta = findBox(f, *moov, [b"udta", b"meta"])
+        tags = readTags(f, meta) if meta else {}
+        mdhd = findBox(f, *trak, [b"mdia", b"mdhd"])
+        timescale, duration = readTimescale(f, mdhd[0])
+        stsd = findBox(f, *trak, stsdPath)
+        if not stsd:
+            raise ValueError("stsd box not found")
+        f.seek(stsd[0] + 12)
+        codec = f.read(4)
+        f.seek(stsd[0] + 32)
+        channels, _, _, _, sampleRate = struct.unpack(">HHHHI", f.read(12))
+    stream = {
+        "codec_name": mp4Codecs.get(codec, codec.decode("latin-1")),
+        "sample_rate": str(sampleRate >> 16),
+        "channels": channels,
+        "time_base": f"1/{timescale}",
+        "duration_ts": duration,
+    }
+    return {"format": {"tags": tags}, "streams": [stream]}
+
+
+nativeReaders = {
+    ".mp3": readMp3Meta,
+    ".m4a": readMp4Meta,
+    ".m4b": readMp4Meta,
+}
 
 
 def getMetaData(ffprobePath, file):
+    reader = nativeReaders.get(file.suffix.lower())
+    if reader:
+        try:
+            metaData = reader(file)
+        except (OSError, ValueError, IndexError, LookupError, struct.error):
+            metaData = None
+        if metaData:
+            return metaData
+
     ffprobeCmd = getffprobeCmd(ffprobePath, file)
     metaData = json.loads(subprocess.check_output(ffprobeCmd).decode("utf-8"))
+    metaData["format"].setdefault("tags", {})
     return metaData
 
 
-def getConcatList(fileList):
-    concatList = ""
+def probeFiles(ffprobePath, fileList, jobs):
+    # Native reads are quick, the pool is for the files that need ffprobe.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        metaList = executor.map(lambda f: getMetaData(ffprobePath, f), fileList)
+        return {f.name: metaData for f, metaData in zip(fileList, metaList)}
+
+
+def writeConcat(out, fileList):
     for file in fileList:
-        concatList += f"file '{str(file)}\n"
-    return concatList
+        escaped = str(normalized.get(file, file)).replace("'", "'\\''")
+        out.write(f"file '{escaped}'\n")
 
 
 def getTags(metaData, tags):
@@ -190,58 +426,126 @@ def getTags(metaData, tags):
     return retTags
 
 
-def getChapters(fileList, metaData, album, ix):
+def writeChapters(out, fileList, metaData, ix):
     artist, albumArtist = getTags(
         metaData[fileList[0].name], ["artist", "album_artist"]
     )
+    out.write(";FFMETADATA1\n")
     if pargs.split:
-        chapters = f";FFMETADATA1\ntitle={album} - Part {str(i+1)}\nalbum={album}\ntrack={str(ix+1)}\n"
+        out.write(f"title={album} - Part {str(ix+1)}\n")
     else:
-        chapters = f";FFMETADATA1\ntitle={album}\nalbum={album}\ntrack={str(ix+1)}\n"
+        out.write(f"title={album}\n")
+    out.write(f"album={album}\ntrack={str(ix+1)}\n")
     if artist or albumArtist:
-        chapters += f"artist={albumArtist or artist}\n"
+        out.write(f"artist={albumArtist or artist}\n")
     else:
-        chapters += f"artist={fileList[0].parent.parent.stem}\n"
+        out.write(f"artist={fileList[0].parent.parent.stem}\n")
     prevDur = 0
     for file in fileList:
         timeBase = metaData[file.name]["streams"][0]["time_base"]
         duration = int(metaData[file.name]["streams"][0]["duration_ts"])
         artist = getTags(metaData[file.name], ["artist"])[0]
         title = slugify(metaData[file.name]["format"]["tags"].get("title", file.name))
-        chapters += f"\n[CHAPTER]\nTIMEBASE={timeBase}\nSTART={str(prevDur)}\n"
+        out.write(f"\n[CHAPTER]\nTIMEBASE={timeBase}\nSTART={str(prevDur)}\n")
         prevDur += duration
-        chapters += f"END={str(prevDur)}\ntitle={title}\n"
+        out.write(f"END={str(prevDur)}\ntitle={title}\n")
         if artist:
-            chapters += f"artist={artist}\n"
-    return chapters
+            out.write(f"artist={artist}\n")
 
 
-def writeChapters(dirPath, fileList, metaData, i):
-    chaptersFile = dirPath.joinpath("chapters")
-    with open(chaptersFile, "w") as ch:
-        ch.write(getChapters(fileList, metaData, album, i))
-    return chaptersFile
+def renderText(writer, *args):
+    # Rendered before ffmpeg starts, so a missing tag or duration raises on the
+    # caller's thread instead of cutting the pipe short in a writer thread.
+    out = io.StringIO()
+    writer(out, *args)
+    return out.getvalue()
 
 
-def writeConcat(dirPath, fileList):
-    concatFile = dirPath.joinpath("concat")
-    with open(concatFile, "w") as cc:
-        cc.write(getConcatList(fileList))
-    return concatFile
+def feedPipe(fd, text):
+    # ffmpeg exiting early closes the read end, its error is what gets reported
+    try:
+        with open(fd, "w", encoding="utf-8") as out:
+            out.write(text)
+    except BrokenPipeError:
+        pass
 
 
-def runCmd(cmd):
+def muxPart(ffmpegPath, partFiles, metaData, outFile, ix):
+    """
+    Run ffmpeg for one part with the concat list on stdin and the chapters on
+    an inherited pipe, so no temp files are written next to the output.
+    Windows can't pass extra fds, so there the chapters go through a file in
+    the system temp dir.
+    """
     print("\n------------------------------------")
-    print("\n", cmd[-1])
-    subprocess.run(cmd)
+    print("\n", outFile)
+    concatText = renderText(writeConcat, partFiles)
+    chText = renderText(writeChapters, partFiles, metaData, ix)
+    concatRead, concatWrite = os.pipe()
+    feeds = [(concatWrite, concatText)]
+    readFds = [concatRead]
+    chFile = None
+    # the finally also removes the chapters file when ffmpeg can't be started
+    try:
+        if os.name == "nt":
+            chFile = tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", suffix=".txt", delete=False
+            )
+            with chFile:
+                chFile.write(chText)
+            chInput = chFile.name
+        else:
+            chRead, chWrite = os.pipe()
+            feeds.append((chWrite, chText))
+            readFds.append(chRead)
+            chInput = f"pipe:{chRead}"
+        cmd = getffmpegCmd(ffmpegPath, "pipe:0", chInput, outFile)
+        try:
+            proc = subprocess.Popen(cmd, stdin=concatRead, pass_fds=readFds[1:])
+        except OSError:
+            for fd, _ in feeds:
+                os.close(fd)
+            raise
+        finally:
+            for fd in readFds:
+                os.close(fd)
+        writers = [threading.Thread(target=feedPipe, args=feed) for feed in feeds]
+        for writer in writers:
+            writer.start()
+        returnCode = proc.wait()
+        for writer in writers:
+            writer.join()
+    finally:
+        if chFile:
+            os.unlink(chFile.name)
     print("\n------------------------------------\n")
+    return returnCode
+
+
+def runPart(partFiles, outFile, ix):
+    # None if the part was already finished, otherwise ffmpeg's return code
+    if isFinished(finished, outFile):
+        print(f"\nAlready finished, skipping: {outFile.name}")
+        return None
+    return muxPart(ffmpegPath, partFiles, metaData, outFile, ix)
 
 
 pargs = parseArgs()
 
 dirPath = pargs.dir.resolve()
 
-fileList = sorted(getFileList(dirPath), key=lambda k: nSort(str(k.stem)))
+journalPath = dirPath.joinpath(".chapterize.journal.jsonl")
+
+# A journal left behind means the previous run was interrupted, the inputs it
+# already moved to dry/ are needed to rebuild the same parts.
+resume = journalPath.exists()
+
+fileList = getFileList(dirPath)
+
+if resume and dirPath.joinpath("dry").is_dir():
+    fileList += getFileList(dirPath.joinpath("dry"))
+
+fileList = sorted(fileList, key=lambda k: nSort(str(k.stem)))
 
 if not fileList:
     print("Nothing to do.")
@@ -249,13 +553,11 @@ if not fileList:
 
 audioExt = fileList[0].suffix
 
-totalSize = bytesToMB(getFileSizes(fileList))
-
 ffprobePath, ffmpegPath = checkPaths(
     {"ffprobe": r"C:\ffmpeg\bin\ffprobe.exe", "ffmpeg": r"C:\ffmpeg\bin\ffmpeg.exe"}
 )
 
-metaData = {str(f.name): getMetaData(ffprobePath, f) for f in fileList}
+metaData = probeFiles(ffprobePath, fileList, pargs.jobs)
 
 album = slugify(
     metaData[fileList[0].name]["format"]["tags"].get("album", f"{str(dirPath.name)}")
@@ -266,31 +568,95 @@ if pargs.ignore_tags:
 
 outDir, dryDir = makeTargetDirs(dirPath, ["out", "dry"])
 
+finished = loadJournal(journalPath)
+
+journal = openJournal(journalPath)
+
 if pargs.split:
-    splitInfo = getSize(totalSize, pargs.split)
-    splitSize = splitInfo[1]
-    splitNum = math.ceil(len(fileList) / splitInfo[0])
+    sizes = [f.stat().st_size for f in fileList]
+    if pargs.pack_by == "duration":
+        weights = [getDurationMs(metaData[f.name]) for f in fileList]
+    else:
+        weights = sizes
+    parts = packParts(sizes, weights, pargs.split << 20)
 else:
-    splitInfo = [1]
+    parts = [(0, len(fileList))]
+
+normalized = {}
+
+if pargs.normalize:
+    targetParams = getTargetParams(fileList, metaData)
+    audioExt = next(
+        (
+            f.suffix
+            for f in fileList
+            if getAudioParams(metaData[f.name]) == targetParams
+        ),
+        encoders[targetParams[0]][1],
+    )
 
-for i in range(splitInfo[0]):
+partJobs = []
+for i, (partStart, partEnd) in enumerate(parts):
     if pargs.split:
-        partFiles = fileList[splitNum * i : splitNum * (i + 1)]
+        partFiles = fileList[partStart:partEnd]
         outFile = outDir.joinpath(f"{album} - Part {str(i+1)}{audioExt}")
     else:
         partFiles = fileList
         outFile = outDir.joinpath(f"{album}{audioExt}")
+    partJobs.append((partFiles, outFile, i))
+
+if pargs.normalize:
+    # only the tracks of parts that still need muxing
+    mismatched = [
+        f
+        for partFiles, outFile, _ in partJobs
+        if not isFinished(finished, outFile)
+        for f in partFiles
+        if getAudioParams(metaData[f.name]) != targetParams
+    ]
+    if mismatched:
+        print(f"\nNormalizing {len(mismatched)} tracks to {targetParams}")
+        normDir = tempfile.TemporaryDirectory(prefix=".normalize-", dir=outDir)
+        normalized = normalizeFiles(
+            ffmpegPath, mismatched, targetParams, pathlib.Path(normDir.name), pargs.jobs
+        )
+        if normalized is None:
+            normDir.cleanup()
+            closeJournal(journal)
+            print("\nFailed to normalize, nothing was merged.")
+            sys.exit(1)
+
+failed = []
+
+with ThreadPoolExecutor(max_workers=pargs.mux_jobs) as executor:
+    futures = {}
+    for partFiles, outFile, i in partJobs:
+        futures[executor.submit(runPart, partFiles, outFile, i)] = (partFiles, outFile)
+
+    # inputs only move to dry/ once their part is done, a failed part leaves
+    # its inputs in place for the next run to resume from
+    for future in as_completed(futures):
+        partFiles, outFile = futures[future]
+        returnCode = future.result()
+        if returnCode:
+            failed.append(outFile.name)
+            continue
+        if returnCode == 0:
+            # parts are few and slow to redo, so every one is synced
+            addJournal(journal, outFile, syncEvery=1)
+        for file in partFiles:
+            dryFile = dryDir.joinpath(file.name)
+            if file != dryFile:
+                file.rename(dryFile)
 
-    ccFile = writeConcat(outDir, partFiles)
-    chFile = writeChapters(outDir, partFiles, metaData, i)
-    cmd = getffmpegCmd(ffmpegPath, str(ccFile), str(chFile), str(outFile))
-    runCmd(cmd)
-    ccFile.unlink()
-    chFile.unlink()
+closeJournal(journal)
 
-    for file in partFiles:
-        dryFile = dryDir.joinpath(file.name)
-        file.rename(dryFile)
+if normalized:
+    normDir.cleanup()
+
+if failed:
+    print(f"\nFailed: {', '.join(failed)}\nRun again to retry the failed parts.")
+    sys.exit(1)
 
 for file in outDir.iterdir():
     newPath = dirPath.joinpath(file.name)
@@ -298,6 +664,8 @@ for file in outDir.iterdir():
 
 rmEmptyDirs([outDir, dryDir])
 
+journalPath.unlink()
+
 # https://trac.ffmpeg.org/wiki/Concatenate
 # https://ffmpeg.org/ffmpeg-formats.html#Metadata-1
 # https://ffmpeg.org/ffmpeg-formats.html#concat-1
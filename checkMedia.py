@@ -1,13 +1,24 @@
 import math
+import os
+import random
+import sqlite3
+import struct
+from array import array
 from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from json import loads
+from fractions import Fraction
+from functools import partial
+from json import dumps, loads
 from pathlib import Path
 from shutil import which
-from statistics import fmean, mode
+from statistics import fmean, variance
 from subprocess import run
 from traceback import format_exc
 
+from mediaUtils import iterBoxes, readTimescale
+
 
 def parseArgs():
     def checkDirPath(pth):
@@ -24,6 +35,16 @@ def parseArgs():
             return [exts]
             # raise ArgumentTypeError("Invalid extensions list")
 
+    def sampleSize(size):
+        try:
+            if size.endswith("%") and 0 < float(size[:-1]) <= 100:
+                return float(size[:-1]) / 100
+            elif not size.endswith("%") and int(size) > 0:
+                return int(size)
+        except ValueError:
+            pass
+        raise ArgumentTypeError("Invalid sample size, expected N or P%")
+
     parser = ArgumentParser(
         description=(
             "Calculate Sum/Mean/Mode statistics for Video/Audio "
@@ -47,15 +68,207 @@ def parseArgs():
         help="Comma separated file extensions. (default: .mp4, .mov)",
         type=sepExts,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        nargs="?",
+        default=1,
+        const=os.cpu_count(),
+        type=int,
+        help="Number of parallel ffprobe processes. (default: 1, no value: CPU count)",
+    )
+    parser.add_argument(
+        "-s",
+        "--streams",
+        action="store_true",
+        help=(
+            "Also probe individual streams and print per codec/resolution/"
+            "sample rate summaries."
+        ),
+    )
+    parser.add_argument(
+        "-S",
+        "--sample",
+        type=sampleSize,
+        help=(
+            "Only probe a sample of N files or P%% of files, stratified by "
+            "directory and file size, and estimate totals from it."
+        ),
+    )
+    parser.add_argument(
+        "-f",
+        "--ffprobe-only",
+        action="store_true",
+        help="Always use ffprobe, skip the native MP4/MOV header reader.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        nargs="?",
+        default=None,
+        const=getCachePath(),
+        type=Path,
+        help=(
+            "Cache probed metadata in a SQLite file, only new or changed files "
+            "are probed. (default: $XDG_CACHE_HOME/PyUtils/checkMedia.sqlite)"
+        ),
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=(
+            "Keep a manifest of scanned files and stored totals in the cache file, "
+            "only added or modified files are probed on later runs."
+        ),
+    )
+
+    pargs = parser.parse_args()
+    if pargs.incremental and (pargs.sample or pargs.streams):
+        parser.error("--incremental can't be used with --sample or --streams")
+    return pargs
 
-    return parser.parse_args()
+
+def getCachePath():
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+    return Path(cacheHome).joinpath("PyUtils", "checkMedia.sqlite")
 
 
 round2 = lambda x: round(float(x), ndigits=2)
 
 secsToHMS = lambda sec: str(timedelta(seconds=sec)).split(".")[0]
 
-collectAtElement = lambda itr, idx: [x[idx] for x in itr]
+newSketch = lambda k=200: {"k": k, "count": 0, "levels": [[]], "size": 0, "capacity": k}
+
+levelCapacity = lambda k, height, level: max(
+    2, math.ceil(k * (2 / 3) ** (height - level - 1))
+)
+
+
+sketchCapacity = lambda k, height: sum(
+    levelCapacity(k, height, h) for h in range(height)
+)
+
+
+def compactSketch(sketch):
+    # KLL sketch: while the sketch is over capacity, the lowest full level is
+    # sorted and every other item is promoted to the next level with double
+    # weight, so memory stays O(k) regardless of count.
+    k, levels = sketch["k"], sketch["levels"]
+    while sum(map(len, levels)) >= sketchCapacity(k, len(levels)):
+        for h, level in enumerate(levels):
+            if len(level) >= levelCapacity(k, len(levels), h):
+                break
+        if h + 1 == len(levels):
+            levels.append([])
+        level = sorted(level)
+        levels[h] = [level.pop()] if len(level) % 2 else []
+        levels[h + 1].extend(level[random.getrandbits(1) :: 2])
+    sketch["size"] = sum(map(len, levels))
+    sketch["capacity"] = sketchCapacity(k, len(levels))
+
+
+def addSketch(sketch, x):
+    sketch["count"] += 1
+    sketch["levels"][0].append(x)
+    sketch["size"] += 1
+    if sketch["size"] >= sketch["capacity"]:
+        compactSketch(sketch)
+
+
+def mergeSketch(sketch, other):
+    for h, level in enumerate(other["levels"]):
+        if h == len(sketch["levels"]):
+            sketch["levels"].append([])
+        sketch["levels"][h].extend(level)
+    sketch["count"] += other["count"]
+    compactSketch(sketch)
+    return sketch
+
+
+def sketchQuantiles(sketch, quantiles):
+    items = sorted(
+        (x, 1 << h) for h, level in enumerate(sketch["levels"]) for x in level
+    )
+    total = sum(w for _, w in items)
+    results = []
+    for q in quantiles:
+        rank, cum = q * total, 0
+        for x, w in items:
+            cum += w
+            if cum >= rank:
+                break
+        results.append(x)
+    return results
+
+
+newStats = lambda: {
+    "count": 0,
+    "sum": 0.0,
+    "mean": 0.0,
+    "m2": 0.0,
+    "sketch": newSketch(),
+}
+
+
+def addStat(stats, x):
+    # Welford's online algorithm, constant memory regardless of count
+    stats["count"] += 1
+    stats["sum"] += x
+    delta = x - stats["mean"]
+    stats["mean"] += delta / stats["count"]
+    stats["m2"] += delta * (x - stats["mean"])
+    addSketch(stats["sketch"], x)
+
+
+def mergeStats(stats, other):
+    # Chan et al. parallel variant of Welford's algorithm
+    count = stats["count"] + other["count"]
+    if not other["count"]:
+        return stats
+    delta = other["mean"] - stats["mean"]
+    stats["m2"] += other["m2"] + delta**2 * stats["count"] * other["count"] / count
+    stats["mean"] += delta * other["count"] / count
+    stats["count"] = count
+    stats["sum"] += other["sum"]
+    mergeSketch(stats["sketch"], other["sketch"])
+    return stats
+
+
+def stdDev(stats):
+    if stats["count"] < 2:
+        return 0.0
+    return math.sqrt(stats["m2"] / (stats["count"] - 1))
+
+
+newAggregate = lambda: {
+    "duration": newStats(),
+    "bitRate": newStats(),
+    "streams": Counter(),
+}
+
+
+def addToAggregate(agg, duration, bitRate, nbStreams):
+    addStat(agg["duration"], duration)
+    addStat(agg["bitRate"], bitRate)
+    agg["streams"][nbStreams] += 1
+
+
+def mergeAggregates(agg, other):
+    mergeStats(agg["duration"], other["duration"])
+    mergeStats(agg["bitRate"], other["bitRate"])
+    agg["streams"].update(other["streams"])
+    return agg
+
+
+def dumpAggregate(agg):
+    return dumps({**agg, "streams": list(agg["streams"].items())})
+
+
+def loadAggregate(data):
+    agg = loads(data)
+    agg["streams"] = Counter(dict(agg["streams"]))
+    return agg
 
 
 def convertSize(sBytes):
@@ -77,20 +290,379 @@ def runCmd(cmd):
     return cmdOut
 
 
-def getMetaData(ffprobePath, file):
-    ffprobeCmd = getffprobeCmd(ffprobePath, file)
+def readMp4Format(file):
+    """
+    Read duration, overall bit rate and stream count from the moov/mvhd/trak
+    boxes without ffprobe. Returns None for fragmented files.
+    """
+    fileSize = file.stat().st_size
+    with open(file, "rb") as f:
+        moov = None
+        for boxType, start, end in iterBoxes(f, 0, fileSize):
+            if boxType == b"moof":
+                return None
+            if boxType == b"moov":
+                moov = (start, end)
+        if not moov:
+            raise ValueError("moov box not found")
+
+        timescale = duration = None
+        nbStreams = 0
+        for boxType, start, end in iterBoxes(f, *moov):
+            if boxType == b"mvex":
+                return None
+            elif boxType == b"trak":
+                nbStreams += 1
+            elif boxType == b"mvhd":
+                timescale, duration = readTimescale(f, start)
+
+    if not timescale or not duration:
+        raise ValueError("Invalid mvhd box")
+
+    duration = duration / timescale
+    return {
+        "format": {
+            "duration": str(duration),
+            "bit_rate": str(int(fileSize * 8 / duration)),
+            "nb_streams": nbStreams,
+        }
+    }
+
+
+def getMetaData(ffprobePath, file, native=True, streams=False):
+    if native and not streams and file.suffix.lower() in mp4Exts:
+        try:
+            metaData = readMp4Format(file)
+        except (OSError, ValueError, IndexError, struct.error):
+            metaData = None
+        if metaData:
+            return metaData
+
+    ffprobeCmd = getffprobeCmd(ffprobePath, file, streams)
     cmdOut = runCmd(ffprobeCmd)
     if isinstance(cmdOut, Exception):
         return cmdOut
-    metaData = loads(cmdOut)
+    try:
+        metaData = loads(cmdOut)
+    except Exception as jsonErr:
+        return jsonErr
     return metaData
 
 
+def imapBounded(func, items, jobs=1):
+    # Yields (item, result) in input order with at most 2 * jobs calls in flight,
+    # so results are never buffered for the whole input.
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= jobs * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
 def getFormatData(meta):
     fmt = meta["format"]
     return (float(fmt["duration"]), float(fmt["bit_rate"]), float(fmt["nb_streams"]))
 
 
+toFloat = lambda x: float(Fraction(x)) if x and not x.endswith("/0") else math.nan
+
+# NaN never equals itself, so grouped columns use 0.0 for missing values
+toKeyFloat = lambda x: float(Fraction(x)) if x and not x.endswith("/0") else 0.0
+
+
+def newStreamTable():
+    # Columnar stream table, text columns are stored as codes into "labels".
+    return {
+        "codec_type": array("I"),
+        "codec_name": array("I"),
+        "pix_fmt": array("I"),
+        "height": array("I"),
+        "frame_rate": array("d"),
+        "sample_rate": array("I"),
+        "channels": array("I"),
+        "duration": array("d"),
+        "bit_rate": array("d"),
+        "labels": {},
+    }
+
+
+def encodeLabel(table, value):
+    labels = table["labels"]
+    return labels.setdefault(value or "", len(labels))
+
+
+streamColumns = (
+    "codec_type",
+    "codec_name",
+    "pix_fmt",
+    "height",
+    "frame_rate",
+    "sample_rate",
+    "channels",
+    "duration",
+    "bit_rate",
+)
+
+
+def getStreamRows(table, meta):
+    fmtDuration = meta["format"].get("duration")
+    return [
+        (
+            encodeLabel(table, stream.get("codec_type")),
+            encodeLabel(table, stream.get("codec_name")),
+            encodeLabel(table, stream.get("pix_fmt")),
+            int(stream.get("height", 0)),
+            toKeyFloat(stream.get("r_frame_rate")),
+            int(stream.get("sample_rate", 0)),
+            int(stream.get("channels", 0)),
+            toFloat(stream.get("duration", fmtDuration)),
+            toFloat(stream.get("bit_rate")),
+        )
+        for stream in meta["streams"]
+    ]
+
+
+def addStreamRows(table, rows):
+    # rows are parsed up front so a bad stream can't leave the columns misaligned
+    for row in rows:
+        for col, value in zip(streamColumns, row):
+            table[col].append(value)
+
+
+def groupStreams(table, keys):
+    # Single pass over the key and value columns, returns
+    # {key tuple: [count, sum duration, sum bit rate, bit rate count]}.
+    groups = {}
+    keyCols = zip(*(table[k] for k in keys))
+    for key, dur, bitRate in zip(keyCols, table["duration"], table["bit_rate"]):
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0.0, 0.0, 0]
+        group[0] += 1
+        if dur == dur:  # skip NaN
+            group[1] += dur
+        if bitRate == bitRate:
+            group[2] += bitRate
+            group[3] += 1
+    return groups
+
+
+def printStreamGroups(title, groups, fmtKey):
+    print(f"\n{title}:")
+    print(f"{'':<28}{'Count':>8}{'Sum Duration':>16}{'Mean Bit Rate':>16}")
+    for key, (count, sumDur, sumBitR, bitRCount) in sorted(
+        groups.items(), key=lambda g: -g[1][0]
+    ):
+        meanBitR = convertSize(round2(sumBitR / bitRCount)) if bitRCount else "N/A"
+        print(
+            f"{fmtKey(key):<28}{count:>8}"
+            f"{secsToHMS(round2(sumDur)):>16}{meanBitR:>16}"
+        )
+
+
+def printStreamSummary(table):
+    labels = {code: label for label, code in table["labels"].items()}
+    video, audio = table["labels"].get("video"), table["labels"].get("audio")
+
+    print(f"\nStream summary for {len(table['codec_type'])} streams:")
+    printStreamGroups(
+        "By Codec",
+        groupStreams(table, ("codec_type", "codec_name")),
+        lambda k: f"{labels[k[0]]}/{labels[k[1]]}",
+    )
+    printStreamGroups(
+        "By Video Resolution/Frame Rate/Pixel Format",
+        {
+            k[1:]: v
+            for k, v in groupStreams(
+                table, ("codec_type", "height", "frame_rate", "pix_fmt")
+            ).items()
+            if k[0] == video
+        },
+        lambda k: f"{k[0]}p {round2(k[1]) if k[1] else 'N/A '}fps {labels[k[2]]}",
+    )
+    printStreamGroups(
+        "By Audio Sample Rate/Channels",
+        {
+            k[1:]: v
+            for k, v in groupStreams(
+                table, ("codec_type", "sample_rate", "channels")
+            ).items()
+            if k[0] == audio
+        },
+        lambda k: f"{k[0]} Hz {k[1]} ch",
+    )
+
+
+def openCache(cachePath):
+    cachePath.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(cachePath)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS metadata (path TEXT, streams INTEGER, "
+        "size INTEGER, mtime_ns INTEGER, data TEXT, PRIMARY KEY (path, streams))"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS manifest (root TEXT, path TEXT, size INTEGER, "
+        "mtime_ns INTEGER, duration REAL, bit_rate REAL, nb_streams REAL, "
+        "PRIMARY KEY (root, path))"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS dir_aggregate (root TEXT, dir TEXT, data TEXT, "
+        "PRIMARY KEY (root, dir))"
+    )
+    return con
+
+
+def getCacheKey(file, streams=False):
+    stat = file.stat()
+    return (str(file), int(streams), stat.st_size, stat.st_mtime_ns)
+
+
+def probeFilesCached(
+    con, getMeta, fileList, cacheStats, jobs=1, streams=False, commitEvery=500
+):
+    # Cache lookups and inserts stay on the calling thread, only misses are
+    # handed to the worker threads. Inserts are committed in batches so an
+    # interrupted run keeps what it already probed.
+    def lookup(file):
+        key = getCacheKey(file, streams)
+        row = con.execute(
+            "SELECT data FROM metadata "
+            "WHERE path = ? AND streams = ? AND size = ? AND mtime_ns = ?",
+            key,
+        ).fetchone()
+        return file, key, (loads(row[0]) if row else None)
+
+    def probe(item):
+        file, _, cached = item
+        return cached or getMeta(file)
+
+    for (file, key, cached), meta in imapBounded(probe, map(lookup, fileList), jobs):
+        if cached:
+            cacheStats["hits"] += 1
+        else:
+            cacheStats["misses"] += 1
+            if not isinstance(meta, Exception):
+                con.execute(
+                    "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                    (*key, dumps(meta)),
+                )
+            if cacheStats["misses"] % commitEvery == 0:
+                con.commit()
+        yield file, meta
+    con.commit()
+
+
+def diffManifest(con, root, scanned):
+    """
+    Compare a scanFiles walk with the stored manifest of root. Returns the files to
+    probe, the directories whose stored partial aggregates are out of date and the
+    added/modified/removed counts.
+    """
+    con.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS scan "
+        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)"
+    )
+    con.execute("DELETE FROM scan")
+    con.executemany("INSERT INTO scan VALUES (?, ?, ?)", scanned)
+
+    counts, staleDirs = Counter(), set()
+    for pth, removed in con.execute(
+        "SELECT m.path, s.path IS NULL "
+        "FROM manifest m LEFT JOIN scan s ON s.path = m.path WHERE m.root = ? AND "
+        "(s.path IS NULL OR s.size != m.size OR s.mtime_ns != m.mtime_ns)",
+        (root,),
+    ):
+        staleDirs.add(os.path.dirname(pth))
+        counts["removed" if removed else "modified"] += 1
+
+    changed = [
+        Path(pth)
+        for (pth,) in con.execute(
+            "SELECT s.path FROM scan s "
+            "LEFT JOIN manifest m ON m.root = ? AND m.path = s.path "
+            "WHERE m.path IS NULL OR s.size != m.size OR s.mtime_ns != m.mtime_ns "
+            "ORDER BY s.rowid",
+            (root,),
+        )
+    ]
+    staleDirs.update(str(file.parent) for file in changed)
+    counts["added"] = len(changed) - counts["modified"]
+
+    # manifests written before the partials were stored have none to reuse
+    if not con.execute(
+        "SELECT 1 FROM dir_aggregate WHERE root = ? LIMIT 1", (root,)
+    ).fetchone():
+        rows = con.execute("SELECT path FROM manifest WHERE root = ?", (root,))
+        staleDirs.update(os.path.dirname(pth) for (pth,) in rows)
+    return changed, staleDirs, counts
+
+
+def getDirAggregate(con, root, dirPath):
+    # A directory's manifest rows are a range of the (root, path) key, the range
+    # also covers its subdirectories so their files are skipped here.
+    agg = newAggregate()
+    for pth, *formatData in con.execute(
+        "SELECT path, duration, bit_rate, nb_streams FROM manifest "
+        "WHERE root = ? AND path > ? AND path < ?",
+        (root, dirPath + os.sep, dirPath + chr(ord(os.sep) + 1)),
+    ):
+        if os.path.dirname(pth) == dirPath:
+            addToAggregate(agg, *formatData)
+    return agg
+
+
+def updateManifest(con, root, rows, staleDirs):
+    """
+    rows: (path, duration, bit_rate, nb_streams) of the newly probed files, failed
+    files are left out so they are probed again on the next run. The partial
+    aggregates (sketches included) of staleDirs are rebuilt from the manifest,
+    the others are reused as stored, returns all of them merged.
+    """
+    con.execute(
+        "DELETE FROM manifest WHERE root = ? AND NOT EXISTS (SELECT 1 FROM scan s "
+        "WHERE s.path = manifest.path AND s.size = manifest.size "
+        "AND s.mtime_ns = manifest.mtime_ns)",
+        (root,),
+    )
+    con.executemany(
+        "INSERT OR REPLACE INTO manifest "
+        "SELECT ?, path, size, mtime_ns, ?, ?, ? FROM scan WHERE path = ?",
+        ((root, *formatData, pth) for pth, *formatData in rows),
+    )
+
+    # Quantile sketches can't subtract values, so only the partials of
+    # directories with changes are rebuilt instead of the whole total.
+    for dirPath in staleDirs:
+        agg = getDirAggregate(con, root, dirPath)
+        if agg["duration"]["count"]:
+            con.execute(
+                "INSERT OR REPLACE INTO dir_aggregate VALUES (?, ?, ?)",
+                (root, dirPath, dumpAggregate(agg)),
+            )
+        else:
+            con.execute(
+                "DELETE FROM dir_aggregate WHERE root = ? AND dir = ?", (root, dirPath)
+            )
+    con.commit()
+
+    totalAgg = newAggregate()
+    for (data,) in con.execute(
+        "SELECT data FROM dir_aggregate WHERE root = ?", (root,)
+    ):
+        mergeAggregates(totalAgg, loadAggregate(data))
+    return totalAgg
+
+
 def checkPath(path, absPath=None):
     path = which(path)
     if path:
@@ -101,6 +673,22 @@ def checkPath(path, absPath=None):
         raise f"{path} or {absPath} is not an executable."
 
 
+def scanFiles(dirPath, exts, rec=False):
+    # os.scandir walk yielding (path, size, mtime_ns), a directory's files come
+    # before its subdirectories.
+    subDirs = []
+    with os.scandir(dirPath) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subDirs.append(entry.path)
+            elif entry.is_file() and Path(entry.name).suffix.lower() in exts:
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+    if rec:
+        for subDir in subDirs:
+            yield from scanFiles(subDir, exts, rec)
+
+
 def getFileList(dirPath, exts, rec=False):
     if rec:
         return [f for f in dirPath.rglob("*.*") if f.suffix.lower() in exts]
@@ -110,18 +698,63 @@ def getFileList(dirPath, exts, rec=False):
         ]
 
 
-getffprobeCmd = lambda ffprobePath, file: [
+def sampleFiles(fileList, sample):
+    # Systematic sample with a random start over files ordered by directory and
+    # size, which spreads the sample proportionally over both (implicit
+    # stratification). The size of every file is returned for the estimators.
+    sizes = {f: f.stat().st_size for f in fileList}
+    count = len(fileList)
+    sampleCount = sample if isinstance(sample, int) else math.ceil(count * sample)
+    sampleCount = min(max(sampleCount, 2), count)
+    ordered = sorted(fileList, key=lambda f: (str(f.parent), sizes[f]))
+    step = count / sampleCount
+    start = random.uniform(0, step)
+    sampled = [ordered[int(start + i * step)] for i in range(sampleCount)]
+    return sampled, sizes
+
+
+def estimateTotals(samples, popCount, popSize, z=1.96):
+    # Duration is estimated with a ratio estimator over file size (duration is
+    # roughly proportional to size), bit rate with the plain sample mean. Both
+    # half widths use the finite population correction.
+    sampleCount = len(samples)
+    sizes, durations, bitRates = zip(*samples)
+    fpc = 1 - sampleCount / popCount
+    ratio = sum(durations) / sum(sizes) if sum(sizes) else 0.0
+    residuals = [d - ratio * x for x, d in zip(sizes, durations)]
+    if sampleCount > 1:
+        durErr = z * popCount * math.sqrt(fpc * variance(residuals) / sampleCount)
+        bitRErr = z * math.sqrt(fpc * variance(bitRates) / sampleCount)
+    else:
+        durErr = bitRErr = math.nan
+    sumDur, meanBitR = ratio * popSize, fmean(bitRates)
+    return {
+        "sumDur": (sumDur, durErr),
+        "meanDur": (sumDur / popCount, durErr / popCount),
+        "sumBitR": (meanBitR * popCount, bitRErr * popCount),
+        "meanBitR": (meanBitR, bitRErr),
+    }
+
+
+fmtEstimate = lambda est, fmt: (
+    f"{fmt(round2(est[0]))} ± {fmt(round2(est[1])) if est[1] == est[1] else 'N/A'}"
+)
+
+
+getffprobeCmd = lambda ffprobePath, file, streams=False: [
     ffprobePath,
     "-v",
     "quiet",
     "-print_format",
     "json",
     "-show_format",
-    # "-show_streams",
+    *(["-show_streams"] if streams else []),
     str(file),
 ]
 
 
+mp4Exts = (".mp4", ".m4v", ".mov", ".m4a", ".m4b")
+
 ffprobePath = checkPath("ffprobe", r"D:\PortableApps\bin\ffprobe.exe")
 
 
@@ -136,51 +769,153 @@ def reportErrExit(exp=None):
     exit()
 
 
-def checkExceptions(output):
-    for o in iter(output):
-        if isinstance(o, Exception):
-            reportErrExit(o)
+def reportErrors(errors):
+    for f, err in errors:
+        print(f"\n------\nERROR: While processing {f}")
+        if getattr(err, "stderr", None):
+            print(f"\nStdErr: {err.stderr}\nReturn Code: {err.returncode}")
         else:
-            return o
+            print(f"\nException: {err}")
 
 
 pargs = parseArgs()
 
-fileList = getFileList(pargs.dir.resolve(), pargs.extensions, pargs.recursive)
+rootDir = pargs.dir.resolve()
+
+if pargs.cache or pargs.incremental:
+    cacheCon = openCache(pargs.cache or getCachePath())
+
+if pargs.incremental:
+    scanned = scanFiles(rootDir, pargs.extensions, pargs.recursive)
+    fileList, staleDirs, manifestCounts = diffManifest(
+        cacheCon, str(rootDir), scanned
+    )
+    manifestRows = []
+else:
+    fileList = getFileList(rootDir, pargs.extensions, pargs.recursive)
+
+    if not fileList:
+        print("Nothing to do.")
+        exit()
+
+if pargs.sample:
+    popCount = len(fileList)
+    fileList, fileSizes = sampleFiles(fileList, pargs.sample)
+    popSize = sum(fileSizes.values())
+    samples = []
+
+getMeta = partial(
+    getMetaData, ffprobePath, native=not pargs.ffprobe_only, streams=pargs.streams
+)
 
-if not fileList:
+if pargs.cache:
+    cacheStats = Counter()
+    metaData = probeFilesCached(
+        cacheCon, getMeta, fileList, cacheStats, pargs.jobs, pargs.streams
+    )
+else:
+    metaData = imapBounded(getMeta, fileList, pargs.jobs)
+
+streamTable = newStreamTable()
+
+totalAgg, dirAgg, dirPath, errors = newAggregate(), newAggregate(), None, []
+
+# Each probe result is folded into a per directory partial aggregate and then
+# dropped, partials are merged into the total when the directory changes.
+for file, meta in metaData:
+    if file.parent != dirPath:
+        mergeAggregates(totalAgg, dirAgg)
+        dirAgg, dirPath = newAggregate(), file.parent
+    if isinstance(meta, Exception):
+        errors.append((file, meta))
+        continue
+    try:
+        formatData = getFormatData(meta)
+        streamRows = getStreamRows(streamTable, meta) if pargs.streams else ()
+    except (KeyError, ValueError, ZeroDivisionError) as fmtErr:
+        errors.append((file, fmtErr))
+        continue
+    addToAggregate(dirAgg, *formatData)
+    addStreamRows(streamTable, streamRows)
+    if pargs.sample:
+        samples.append((fileSizes[file], *formatData[:2]))
+    if pargs.incremental:
+        manifestRows.append((str(file), *formatData))
+
+mergeAggregates(totalAgg, dirAgg)
+
+if pargs.incremental:
+    # the probed files are already in the partials rebuilt from the manifest
+    totalAgg = updateManifest(cacheCon, str(rootDir), manifestRows, staleDirs)
+
+if pargs.cache or pargs.incremental:
+    cacheCon.close()
+
+if pargs.incremental and not totalAgg["duration"]["count"] and not errors:
     print("Nothing to do.")
     exit()
 
-cmdOut = [getMetaData(ffprobePath, f) for f in fileList]
+durStats, bitRStats = totalAgg["duration"], totalAgg["bitRate"]
 
-checkExceptions(cmdOut)
+if not durStats["count"]:
+    reportErrors(errors)
+    reportErrExit()
 
-formatData = [getFormatData(o) for o in cmdOut]
+modeStreams = totalAgg["streams"].most_common(1)[0][0]
 
-durations = collectAtElement(formatData, 0)
+percentiles = (0.5, 0.9, 0.95, 0.99)
 
-bitRates = collectAtElement(formatData, 1)
+durPercentiles = sketchQuantiles(durStats["sketch"], percentiles)
 
-sumDur = round2(sum(durations))
+bitRPercentiles = sketchQuantiles(bitRStats["sketch"], percentiles)
 
-meanDur = round2(fmean(durations))
 
-sumBitR = round2(sum(bitRates))
+print(
+    f"\nContainer format summary for {durStats['count']} "
+    f"{'sampled ' if pargs.sample else ''}files:\n"
+    f"Sum Duration: {secsToHMS(round2(durStats['sum']))}\n"
+    f"Mean Duration: {secsToHMS(round2(durStats['mean']))}\n"
+    f"Std Dev Duration: {secsToHMS(round2(stdDev(durStats)))}\n"
+    f"Median/P90/P95/P99 Duration: "
+    f"{' / '.join(secsToHMS(round2(x)) for x in durPercentiles)}\n"
+    f"Sum Bit Rate: {convertSize(round2(bitRStats['sum']))}\n"
+    f"Mean Bit Rate: {convertSize(round2(bitRStats['mean']))}\n"
+    f"Std Dev Bit Rate: {convertSize(round2(stdDev(bitRStats)))}\n"
+    f"Median/P90/P95/P99 Bit Rate: "
+    f"{' / '.join(convertSize(round2(x)) for x in bitRPercentiles)}\n"
+    f"Mode Number of Streams: {int(modeStreams)}"
+)
 
-meanBitR = round2(fmean(bitRates))
+if pargs.sample:
+    # files that failed to probe are assumed to be as common outside the sample
+    okCount = len(samples) / len(fileList)
+    okSize = sum(x[0] for x in samples) / (sum(fileSizes[f] for f in fileList) or 1)
+    estimate = estimateTotals(samples, popCount * okCount, popSize * okSize)
+    print(
+        f"\nEstimate for all {popCount} files "
+        f"({len(samples)} sampled, 95% confidence):\n"
+        f"Sum Duration: {fmtEstimate(estimate['sumDur'], secsToHMS)}\n"
+        f"Mean Duration: {fmtEstimate(estimate['meanDur'], secsToHMS)}\n"
+        f"Sum Bit Rate: {fmtEstimate(estimate['sumBitR'], convertSize)}\n"
+        f"Mean Bit Rate: {fmtEstimate(estimate['meanBitR'], convertSize)}"
+    )
 
-modeStreams = mode(collectAtElement(formatData, 2))
+if pargs.streams:
+    printStreamSummary(streamTable)
 
+if pargs.incremental:
+    print(
+        f"Added Files: {manifestCounts['added']}; "
+        f"Modified Files: {manifestCounts['modified']}; "
+        f"Removed Files: {manifestCounts['removed']}"
+    )
 
-print(
-    f"\nContainer format summary for {len(formatData)} files:\n"
-    f"Sum Duration: {secsToHMS(sumDur)}\n"
-    f"Mean Duration: {secsToHMS(meanDur)}\n"
-    f"Sum Bit Rate: {convertSize(sumBitR)}\n"
-    f"Mean Bit Rate: {convertSize(meanBitR)}\n"
-    f"Mode Number of Streams: {int(modeStreams)}"
-)
+if pargs.cache:
+    print(f"Cache Hits: {cacheStats['hits']}; Cache Misses: {cacheStats['misses']}")
+
+if errors:
+    print(f"\n{len(errors)} files could not be processed:")
+    reportErrors(errors)
 
 
 # Format: nb_streams, duration, bit_rate, format_name, format_long_name
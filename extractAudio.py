@@ -8,10 +8,25 @@ import argparse
 import glob
 import itertools
 import json
+import os
 import pathlib
 import shutil
+import struct
 import subprocess
 import sys
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mediaUtils import (
+    findBox,
+    findSoundTrack,
+    iterBoxes,
+    readEsds,
+    readId3Size,
+    readMp3Stream,
+    readOggStream,
+    readTimescale,
+)
 
 
 def parseArgs():
@@ -22,6 +37,11 @@ def parseArgs():
         else:
             raise argparse.ArgumentTypeError("Invalid Directory path")
 
+    def jobCount(count):
+        if count.isdigit() and int(count) > 0:
+            return int(count)
+        raise argparse.ArgumentTypeError("Invalid job count, expected 1 or more")
+
     parser = argparse.ArgumentParser(
         description="Extract audio from all files inside a directory(optionally subdirectories) using ffmpeg."
     )
@@ -46,6 +66,37 @@ def parseArgs():
         action="store_true",
         help=r"Dry run / Don't write anything to the disk.",
     )
+    parser.add_argument(
+        "-f",
+        "--ffprobe-only",
+        action="store_true",
+        help="Always use ffprobe, skip the native MP4/MKV header readers.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        nargs="?",
+        default=1,
+        const=os.cpu_count(),
+        type=jobCount,
+        help=(
+            "Number of files extracted concurrently. "
+            "(default: 1, no value: CPU count)"
+        ),
+    )
+    parser.add_argument(
+        "-H",
+        "--hdd-jobs",
+        default=1,
+        type=jobCount,
+        help="Concurrent extractions per spinning disk, default is 1",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Skip files whose _audio output is newer and matches their duration.",
+    )
 
     pargs = parser.parse_args()
 
@@ -76,10 +127,16 @@ audioExt = {
     "ac3": "mka",
 }
 
+outputExts = {*audioExt.values(), "mka"}
+
 videoTypes = (".mp4", ".avi", ".mov", ".wmv", ".mkv", "m4v")
 
+# -nostdin/-n: concurrent runs share the terminal, so an existing output
+# fails instead of prompting
 getCmd = lambda ffmpegPath, fileObj, abs, fileExt: [
     ffmpegPath,
+    "-nostdin",
+    "-n",
     "-i",
     str(fileObj),
     "-vn",
@@ -103,11 +160,279 @@ getffprobeCmd = lambda ffprobePath, file: [
 ]
 
 
+# MPEG-4 objectTypeIndication of the esds DecoderConfigDescriptor
+mp4ObjectTypes = {
+    0x40: "aac",
+    0x66: "aac",
+    0x67: "aac",
+    0x68: "aac",
+    0x69: "mp3",
+    0x6B: "mp3",
+    0xA5: "ac3",
+    0xA6: "eac3",
+    0xDD: "vorbis",
+}
+
+mp4Codecs = {
+    b"ac-3": "ac3",
+    b"ec-3": "eac3",
+    b"Opus": "opus",
+    b"alac": "alac",
+    b"fLaC": "flac",
+    b".mp3": "mp3",
+}
+
+mkvCodecs = {
+    "A_AAC": "aac",
+    "A_MPEG/L3": "mp3",
+    "A_MPEG/L2": "mp2",
+    "A_OPUS": "opus",
+    "A_VORBIS": "vorbis",
+    "A_AC3": "ac3",
+    "A_EAC3": "eac3",
+    "A_FLAC": "flac",
+    "A_DTS": "dts",
+}
+
+mkvIds = {
+    "segment": 0x18538067,
+    "tracks": 0x1654AE6B,
+    "cluster": 0x1F43B675,
+    "trackEntry": 0xAE,
+    "trackType": 0x83,
+    "codecId": 0x86,
+    "info": 0x1549A966,
+    "timecodeScale": 0x2AD7B1,
+    "duration": 0x4489,
+}
+
+
+def readMp4Codec(fileObj):
+    # sample entry type of the first sound track, mp4a is told apart by esds
+    fileSize = fileObj.stat().st_size
+    with open(fileObj, "rb") as f:
+        moov = findBox(f, 0, fileSize, [b"moov"])
+        if not moov:
+            raise ValueError("moov box not found")
+        trak = findSoundTrack(f, moov)
+        if not trak:
+            return None
+        stsd = findBox(f, *trak, [b"mdia", b"minf", b"stbl", b"stsd"])
+        entry = next(iterBoxes(f, stsd[0] + 8, stsd[1]))
+        if entry[0] != b"mp4a":
+            return mp4Codecs.get(entry[0], entry[0].decode("latin-1").strip())
+        # QuickTime sound sample entry v1/v2 have 16/36 more bytes
+        f.seek(entry[1] + 8)
+        version = struct.unpack(">H", f.read(2))[0]
+        childStart = entry[1] + 28 + {1: 16, 2: 36}.get(version, 0)
+        esds = findBox(f, childStart, entry[2], [b"esds"])
+        if not esds:
+            return "aac"
+        decoderConfig = readEsds(f, esds[0])
+        return decoderConfig and mp4ObjectTypes.get(decoderConfig[0])
+
+
+def readEbmlVint(f, keepMarker=False):
+    first = f.read(1)
+    if not first:
+        raise ValueError("Unexpected end of file")
+    length = 9 - first[0].bit_length()
+    if length > 8:
+        raise ValueError("Invalid EBML variable length integer")
+    value = first[0] if keepMarker else first[0] & (0xFF >> length)
+    for byte in f.read(length - 1):
+        value = value << 8 | byte
+    return value, length
+
+
+def iterEbml(f, start, end):
+    pos = start
+    while pos < end:
+        f.seek(pos)
+        elementId, idLen = readEbmlVint(f, keepMarker=True)
+        size, sizeLen = readEbmlVint(f)
+        dataStart = pos + idLen + sizeLen
+        # all ones is an unknown size, the element runs to the end of its parent
+        dataEnd = end if size == (1 << (7 * sizeLen)) - 1 else dataStart + size
+        yield elementId, dataStart, min(dataEnd, end)
+        pos = dataEnd
+
+
+def readMkvCodec(fileObj):
+    # CodecID of the first audio TrackEntry, Tracks comes before the clusters
+    fileSize = fileObj.stat().st_size
+    with open(fileObj, "rb") as f:
+        for elementId, start, end in iterEbml(f, 0, fileSize):
+            if elementId != mkvIds["segment"]:
+                continue
+            for elementId, start, end in iterEbml(f, start, end):
+                if elementId == mkvIds["cluster"]:
+                    return None
+                if elementId != mkvIds["tracks"]:
+                    continue
+                for elementId, trackStart, trackEnd in iterEbml(f, start, end):
+                    if elementId != mkvIds["trackEntry"]:
+                        continue
+                    trackType = codecId = None
+                    for elementId, dataStart, dataEnd in iterEbml(
+                        f, trackStart, trackEnd
+                    ):
+                        f.seek(dataStart)
+                        data = f.read(dataEnd - dataStart)
+                        if elementId == mkvIds["trackType"]:
+                            trackType = int.from_bytes(data, "big")
+                        elif elementId == mkvIds["codecId"]:
+                            codecId = data.rstrip(b"\x00").decode("ascii")
+                    if trackType == 2 and codecId:
+                        for prefix, codec in mkvCodecs.items():
+                            if codecId.startswith(prefix):
+                                return codec
+                        return codecId.lower()
+                return None
+    return None
+
+
+nativeReaders = {
+    ".mp4": readMp4Codec,
+    ".m4v": readMp4Codec,
+    ".mov": readMp4Codec,
+    ".mkv": readMkvCodec,
+}
+
+
+def readMp4Duration(fileObj):
+    fileSize = fileObj.stat().st_size
+    with open(fileObj, "rb") as f:
+        mvhd = findBox(f, 0, fileSize, [b"moov", b"mvhd"])
+        timescale, duration = readTimescale(f, mvhd[0])
+    return duration / timescale
+
+
+def readMp3Duration(fileObj):
+    with open(fileObj, "rb") as f:
+        _, start = readId3Size(f.read(10))
+        stream = readMp3Stream(f, start, fileObj.stat().st_size)
+    return stream[2] / stream[1] if stream else None
+
+
+def readOggDuration(fileObj):
+    with open(fileObj, "rb") as f:
+        stream = readOggStream(f, fileObj.stat().st_size)
+    return stream[2] / stream[0] if stream and stream[2] else None
+
+
+def readMkvDuration(fileObj):
+    # Segment Info Duration in TimecodeScale units (ns, default 1ms)
+    fileSize = fileObj.stat().st_size
+    with open(fileObj, "rb") as f:
+        for elementId, start, end in iterEbml(f, 0, fileSize):
+            if elementId != mkvIds["segment"]:
+                continue
+            for elementId, start, end in iterEbml(f, start, end):
+                if elementId != mkvIds["info"]:
+                    continue
+                scale, duration = 1_000_000, None
+                for elementId, dataStart, dataEnd in iterEbml(f, start, end):
+                    f.seek(dataStart)
+                    data = f.read(dataEnd - dataStart)
+                    if elementId == mkvIds["timecodeScale"]:
+                        scale = int.from_bytes(data, "big")
+                    elif elementId == mkvIds["duration"]:
+                        floatFmt = ">f" if len(data) == 4 else ">d"
+                        duration = struct.unpack(floatFmt, data)[0]
+                return duration * scale / 1e9
+    return None
+
+
+durationReaders = {
+    ".mp4": readMp4Duration,
+    ".m4v": readMp4Duration,
+    ".mov": readMp4Duration,
+    ".m4a": readMp4Duration,
+    ".mkv": readMkvDuration,
+    ".mka": readMkvDuration,
+    ".mp3": readMp3Duration,
+    ".opus": readOggDuration,
+    ".ogg": readOggDuration,
+}
+
+
+def isUpToDate(fileObj, srcStat, outFile, outStat):
+    """
+    The output is newer than the source and, where the source container can be
+    read natively, within 1s or 1% of its duration. Outputs whose duration
+    can't be read (.wma) are never up to date, a cut short one would otherwise
+    be skipped for good.
+    """
+    if outStat.st_mtime < srcStat.st_mtime or not outStat.st_size:
+        return False
+    srcReader = durationReaders.get(fileObj.suffix.lower())
+    outReader = durationReaders.get(outFile.suffix.lower())
+    if not outReader:
+        return False
+    if not srcReader:
+        return True
+    try:
+        srcDuration, outDuration = srcReader(fileObj), outReader(outFile)
+    except (OSError, ValueError, IndexError, TypeError, struct.error):
+        return False
+    if srcDuration is None or outDuration is None:
+        return False
+    return abs(srcDuration - outDuration) <= max(1, srcDuration / 100)
+
+
+def filterUpToDate(fileList):
+    """
+    One scandir pass per directory, returns the files that still need
+    extracting and the stale outputs that have to be removed first so
+    ffmpeg doesn't stop to ask about overwriting them.
+    """
+    dirStats = {}
+    for dirPath in {fileObj.parent for fileObj in fileList}:
+        with os.scandir(dirPath) as it:
+            dirStats[dirPath] = {entry.name: entry.stat() for entry in it}
+
+    pending, stale = [], []
+    for fileObj in fileList:
+        stats = dirStats[fileObj.parent]
+        base = f"{fileObj.name[:-4]}_audio."
+        outputs = [
+            fileObj.with_name(f"{base}{ext}")
+            for ext in outputExts
+            if f"{base}{ext}" in stats
+        ]
+        if any(
+            isUpToDate(fileObj, stats[fileObj.name], outFile, stats[outFile.name])
+            for outFile in outputs
+        ):
+            continue
+        pending.append(fileObj)
+        stale.extend(outputs)
+    return pending, stale
+
+
+def getCodec(ffprobePath, fileObj, native=True):
+    reader = nativeReaders.get(fileObj.suffix.lower()) if native else None
+    if reader:
+        try:
+            codec = reader(fileObj)
+        except (OSError, ValueError, IndexError, TypeError, struct.error):
+            codec = None
+        if codec:
+            return codec
+
+    ffprobeCmd = getffprobeCmd(ffprobePath, fileObj)
+    streams = json.loads(subprocess.check_output(ffprobeCmd).decode("utf-8"))[
+        "streams"
+    ]
+    return streams[0]["codec_name"] if streams else None
+
+
 def runCmd(cmd, dry):
     print("\n---------------------------------------\n")
     print(cmd)
     if not dry:
-        subprocess.run(cmd)
+        subprocess.run(cmd, stdin=subprocess.DEVNULL)
     print("\n---------------------------------------\n")
     # input("\nPress Enter to continue...")
 
@@ -125,6 +450,51 @@ getFileListRec = lambda dirPath: [
 ]
 
 
+def isRotational(dev):
+    # Linux only, None when the device type can't be told (other platforms,
+    # network shares), those get the same limit as SSDs.
+    try:
+        sysPath = pathlib.Path(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    except AttributeError:
+        return None
+    # partitions don't have a queue dir of their own, their disk does
+    for queue in (sysPath / "queue", sysPath / ".." / "queue"):
+        try:
+            return queue.joinpath("rotational").read_text().strip() == "1"
+        except OSError:
+            continue
+    return None
+
+
+def runScheduled(func, fileList, jobs, hddJobs):
+    """
+    Run func over fileList with at most jobs calls in flight overall and at
+    most hddJobs per spinning disk, files are grouped by st_dev and devices
+    are filled round robin so a slow disk doesn't hold up the others.
+    """
+    queues = {}
+    for fileObj in fileList:
+        queues.setdefault(fileObj.stat().st_dev, deque()).append(fileObj)
+    limits = {dev: hddJobs if isRotational(dev) else jobs for dev in queues}
+    counts = Counter()
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while queues or running:
+            submitted = True
+            while submitted and len(running) < jobs:
+                submitted = False
+                for dev, queue in queues.items():
+                    if queue and counts[dev] < limits[dev] and len(running) < jobs:
+                        running[executor.submit(func, queue.popleft())] = dev
+                        counts[dev] += 1
+                        submitted = True
+            queues = {dev: queue for dev, queue in queues.items() if queue}
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                counts[running.pop(future)] -= 1
+                future.result()
+
+
 def main(pargs):
 
     dirPath = pargs.dir.resolve()
@@ -138,16 +508,29 @@ def main(pargs):
         print("Nothing to do.")
         sys.exit()
 
-    for fileObj in fileList:
-        ffprobeCmd = getffprobeCmd(ffprobePath, fileObj)
-
-        codec = json.loads(subprocess.check_output(ffprobeCmd).decode("utf-8"))[
-            "streams"
-        ][0]["codec_name"]
-
-        cmd = getCmd(ffmpegPath, fileObj, pargs.abs, audioExt[codec])
+    if pargs.incremental:
+        total = len(fileList)
+        fileList, stale = filterUpToDate(fileList)
+        print(f"\n{total - len(fileList)} of {total} files are up to date.")
+        if not fileList:
+            sys.exit()
+        if not pargs.dry:
+            for outFile in stale:
+                outFile.unlink()
+
+    def extract(fileObj):
+        codec = getCodec(ffprobePath, fileObj, not pargs.ffprobe_only)
+
+        if not codec:
+            print(f"\nNo audio stream found in {fileObj}, skipping.")
+            return
+
+        # anything without a dedicated extension goes in Matroska audio
+        cmd = getCmd(ffmpegPath, fileObj, pargs.abs, audioExt.get(codec, "mka"))
         runCmd(cmd, pargs.dry)
 
+    runScheduled(extract, fileList, pargs.jobs, pargs.hdd_jobs)
+
 
 main(parseArgs())
 
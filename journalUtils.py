@@ -0,0 +1,64 @@
+"""
+Shared resume journal for chapterSplitsM4a.py and chapterizeAudio.py, a JSON
+lines file of the outputs finished so far and their sizes.
+"""
+
+import json
+import os
+import threading
+
+
+def loadJournal(journalPath):
+    # {output path: size} of finished outputs, a torn last line from an
+    # interrupted run is ignored.
+    finished = {}
+    if os.path.exists(journalPath):
+        with open(journalPath, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                finished[entry["path"]] = entry["size"]
+    return finished
+
+
+def openJournal(journalPath):
+    return {
+        "file": open(journalPath, "a", encoding="utf-8"),
+        "pending": 0,
+        "lock": threading.Lock(),
+    }
+
+
+def syncJournal(journal):
+    journal["file"].flush()
+    os.fsync(journal["file"].fileno())
+    journal["pending"] = 0
+
+
+def addJournal(journal, outFile, syncEvery=16):
+    # fsync is batched, at worst the last syncEvery - 1 outputs are redone
+    # after a crash
+    entry = json.dumps({"path": str(outFile), "size": os.path.getsize(outFile)})
+    with journal["lock"]:
+        journal["file"].write(f"{entry}\n")
+        journal["pending"] += 1
+        if journal["pending"] >= syncEvery:
+            syncJournal(journal)
+
+
+def closeJournal(journal):
+    with journal["lock"]:
+        syncJournal(journal)
+        journal["file"].close()
+
+
+def isFinished(finished, outFile):
+    # Outputs that exist but aren't journaled with the same size are partial
+    # and get removed so ffmpeg doesn't prompt about overwriting them.
+    if os.path.exists(outFile):
+        if finished.get(str(outFile)) == os.path.getsize(outFile):
+            return True
+        os.remove(outFile)
+    return False
@@ -0,0 +1,245 @@
+"""
+Shared MP4 box, MPEG audio frame and Ogg page parsers for the media scripts,
+they read just the headers the scripts need instead of running ffprobe.
+"""
+
+import struct
+
+mp4Tags = {
+    b"\xa9nam": "title",
+    b"\xa9ART": "artist",
+    b"aART": "album_artist",
+    b"\xa9alb": "album",
+}
+
+mp3Bitrates = {
+    (3, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (3, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (3, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+mp3SampleRates = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000)}
+
+
+def iterBoxes(f, start, end):
+    # ISO BMFF boxes: 32-bit size + 4cc type, size 1 means a 64-bit size follows
+    # and size 0 means the box extends to the end of its parent.
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, boxType = struct.unpack(">I4s", f.read(8))
+        headerSize = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            headerSize = 16
+        elif size == 0:
+            size = end - pos
+        if size < headerSize or pos + size > end:
+            raise ValueError(f"Malformed {boxType} box at offset {pos}")
+        yield boxType, pos + headerSize, pos + size
+        pos += size
+
+
+def findBox(f, start, end, path):
+    for boxType, boxStart, boxEnd in iterBoxes(f, start, end):
+        if boxType == path[0]:
+            if len(path) == 1:
+                return boxStart, boxEnd
+            return findBox(f, boxStart, boxEnd, path[1:])
+    return None
+
+
+def findSoundTrack(f, moov):
+    # first trak of moov whose mdia/hdlr handler type is soun
+    for boxType, start, end in iterBoxes(f, *moov):
+        if boxType != b"trak":
+            continue
+        hdlr = findBox(f, start, end, [b"mdia", b"hdlr"])
+        if not hdlr:
+            continue
+        f.seek(hdlr[0] + 8)
+        if f.read(4) == b"soun":
+            return start, end
+    return None
+
+
+def readTimescale(f, start):
+    # mvhd and mdhd share the layout up to the duration
+    f.seek(start)
+    if f.read(4)[0] == 1:
+        return struct.unpack(">16xIQ", f.read(28))
+    return struct.unpack(">8xII", f.read(16))
+
+
+def readTags(f, meta):
+    start, end = meta
+    # meta is a full box in iTunes files but not in QuickTime ones
+    f.seek(start)
+    if f.read(4) == b"\x00\x00\x00\x00":
+        start += 4
+    ilst = findBox(f, start, end, [b"ilst"])
+    tags = {}
+    for boxType, boxStart, boxEnd in iterBoxes(f, *ilst) if ilst else []:
+        data = boxType in mp4Tags and findBox(f, boxStart, boxEnd, [b"data"])
+        if data:
+            f.seek(data[0] + 8)
+            value = f.read(data[1] - data[0] - 8).decode("utf-8", "replace")
+            tags[mp4Tags[boxType]] = value
+    return tags
+
+
+def readDescriptorLen(f):
+    length = 0
+    for _ in range(4):
+        byte = f.read(1)[0]
+        length = length << 7 | byte & 0x7F
+        if not byte & 0x80:
+            break
+    return length
+
+
+def readEsds(f, start):
+    """
+    Returns (objectTypeIndication, avgBitrate) of the DecoderConfigDescriptor
+    (tag 4) in the ES_Descriptor (tag 3) of an esds box or None.
+    """
+    f.seek(start + 4)
+    if f.read(1) != b"\x03":
+        return None
+    readDescriptorLen(f)
+    f.read(2)
+    esFlags = f.read(1)[0]
+    if esFlags & 0x80:
+        f.read(2)
+    if esFlags & 0x40:
+        f.read(f.read(1)[0])
+    if esFlags & 0x20:
+        f.read(2)
+    if f.read(1) != b"\x04":
+        return None
+    readDescriptorLen(f)
+    objectType, _, avgBitrate = struct.unpack(">B4xII", f.read(13))
+    return objectType, avgBitrate
+
+
+def readId3Size(header):
+    """
+    Returns (tag end, audio start) for the first 10 bytes of a file, the audio
+    start also skips the ID3v2.4 footer. (0, 0) if there is no ID3v2 tag.
+    """
+    if header[:3] != b"ID3":
+        return 0, 0
+    end = 10 + (header[6] << 21 | header[7] << 14 | header[8] << 7 | header[9])
+    return end, end + (10 if header[5] & 0x10 else 0)
+
+
+def parseMp3Header(header):
+    """
+    Returns (bitrate, sample rate, samples per frame, frame length, side info
+    length) of an MPEG audio frame header or None if it isn't one.
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3  # 3: MPEG1, 2: MPEG2, 0: MPEG2.5
+    layer = (header[1] >> 1) & 3  # 3: Layer I, 2: Layer II, 1: Layer III
+    brIdx, srIdx = header[2] >> 4, (header[2] >> 2) & 3
+    if version == 1 or layer == 0 or brIdx in (0, 15) or srIdx == 3:
+        return None
+    bitRate = mp3Bitrates[(3 if version == 3 else 2, layer)][brIdx] * 1000
+    sampleRate = mp3SampleRates[3 if version == 3 else 2][srIdx]
+    if version == 0:
+        sampleRate //= 2
+    padding, mono = (header[2] >> 1) & 1, header[3] >> 6 == 3
+    if layer == 3:
+        samples, frameLen = 384, (12 * bitRate // sampleRate + padding) * 4
+    elif layer == 2 or version == 3:
+        samples, frameLen = 1152, 144 * bitRate // sampleRate + padding
+    else:
+        samples, frameLen = 576, 72 * bitRate // sampleRate + padding
+    if version == 3:
+        sideInfo = 17 if mono else 32
+    else:
+        sideInfo = 9 if mono else 17
+    return bitRate, sampleRate, samples, frameLen, sideInfo
+
+
+def findMp3Frame(data):
+    # Returns (offset, parseMp3Header) of the first frame in data or None, the
+    # next frame has to line up to rule out a false sync.
+    for pos in range(len(data) - 4):
+        header = parseMp3Header(data[pos : pos + 4])
+        if not header:
+            continue
+        frameLen = header[3]
+        if pos + frameLen + 4 <= len(data) and parseMp3Header(
+            data[pos + frameLen : pos + frameLen + 4]
+        ):
+            return pos, header
+    return None
+
+
+def readMp3Stream(f, start, fileSize):
+    """
+    Returns (frame header, sample rate, duration in samples) of the first frame
+    after start or None. The duration is the frame count of a Xing/Info or VBRI
+    header, or the audio size over the bitrate for CBR files and VBR files
+    whose header was never filled in by an interrupted encode.
+    """
+    f.seek(start)
+    data = f.read(64 * 1024)
+    f.seek(max(fileSize - 128, 0))
+    id3v1 = f.read(3) == b"TAG"
+
+    frame = findMp3Frame(data)
+    if not frame:
+        return None
+    pos, (bitRate, sampleRate, samples, _, sideInfo) = frame
+
+    frames = None
+    xing = pos + 4 + sideInfo
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        if int.from_bytes(data[xing + 4 : xing + 8], "big") & 1:
+            frames = int.from_bytes(data[xing + 8 : xing + 12], "big")
+    elif data[pos + 36 : pos + 40] == b"VBRI":
+        frames = int.from_bytes(data[pos + 50 : pos + 54], "big")
+
+    if frames:
+        duration = frames * samples
+    else:
+        audioSize = fileSize - start - pos - (128 if id3v1 else 0)
+        duration = round(audioSize * 8 * sampleRate / bitRate)
+    return data[pos : pos + 4], sampleRate, duration
+
+
+def readOggStream(f, fileSize):
+    """
+    Returns (sample rate, Vorbis nominal bitrate, duration in samples) of the
+    first Vorbis/Opus stream or None. The duration is the last page's granule
+    position less the Opus pre-skip, None if no page of the stream has one.
+    """
+    page = f.read(27)
+    if page[:4] != b"OggS":
+        return None
+    serial = page[14:18]
+    packet = f.read(page[26] + 28)[page[26] :]
+    if packet.startswith(b"\x01vorbis"):
+        sampleRate, nominal = struct.unpack("<I4xi", packet[12:24])
+        preSkip = 0
+    elif packet.startswith(b"OpusHead"):
+        sampleRate, preSkip = 48000, struct.unpack("<H", packet[10:12])[0]
+        nominal = 0
+    else:
+        return None
+
+    f.seek(max(0, fileSize - 65536))
+    tail = f.read()
+    pos = tail.rfind(b"OggS")
+    while pos != -1:
+        granule = struct.unpack("<q", tail[pos + 6 : pos + 14])[0]
+        if tail[pos + 14 : pos + 18] == serial and granule > preSkip:
+            return sampleRate, nominal, granule - preSkip
+        pos = tail.rfind(b"OggS", 0, pos)
+    return sampleRate, nominal, None
@@ -1,7 +1,7 @@
-import re
 from argparse import ArgumentParser, ArgumentTypeError
 from pathlib import Path
-from unicodedata import normalize
+
+from slugifyUtils import slugifyBatch
 
 
 def parseArgs():
@@ -72,54 +72,6 @@ def parseArgs():
     return parser.parse_args()
 
 
-def slugify(
-    value,
-    allowUnicode=False,
-    replace=True,
-    keepSpace=True,
-    keepDots=True,
-    lowerCase=False,
-    swap={},  # TODO: expose this to cli?
-):
-    """
-    Adapted from django.utils.text.slugify
-    https://docs.djangoproject.com/en/3.0/_modules/django/utils/text/#slugify
-    """
-    value = str(value)
-
-    if allowUnicode:
-        value = normalize("NFKC", value)
-    else:
-        value = normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
-
-    swap = {"[": "(", "]": ")", **swap}
-    # "," "'", "&" ? # Option to allow Comma?
-    # TODO: Allow specific characters?
-
-    for k, v in swap.items():
-        value = value.replace(k, v)
-
-    rejectPattern = r"[^\w\s)(_-]+"  # r"[^\w\s)(_-]"
-    # \w word characters/alphanumerics, \s whitespace characters,
-    # underscores, parentheses, and hyphens
-    # acceptPattern = rejectPattern.replace("^", "")
-
-    if keepDots:
-        rejectPattern = rejectPattern.replace(r"\s", r"\s.")
-
-    replaceWith = "_" if replace else ""
-
-    value = re.sub(rejectPattern, replaceWith, value).strip()
-
-    if lowerCase:
-        value = value.lower()
-
-    if not keepSpace:
-        value = re.sub(r"[-\s]+", "-", value)
-
-    return value
-
-
 def areYouSure():
     print("\nAre you sure you want to commit these changes? (y/n)")
     try:
@@ -140,23 +92,28 @@ pargs = parseArgs()
 
 dirPath = pargs.dir.resolve()
 
-slugifyP = lambda f: slugify(
-    f, pargs.unicode, pargs.replace, pargs.spaces, pargs.dots, pargs.case
-)
-
-
 fileList = dirPath.glob("*")
 
 if pargs.recursive:
     fileList = dirPath.rglob("*")
 
+fileList = [(f, f.is_file()) for f in fileList]
 
 if pargs.files:
-    fileList = (f for f in fileList if f.is_file())
+    fileList = [(f, isFile) for f, isFile in fileList if isFile]
+
+slugs = slugifyBatch(
+    (f.stem if isFile else f.name for f, isFile in fileList),
+    pargs.unicode,
+    pargs.replace,
+    pargs.spaces,
+    pargs.dots,
+    pargs.case,
+)
 
 slugified = [
-    (f, f.with_stem(slugifyP(f.stem)) if f.is_file() else f.with_name(slugifyP(f.name)))
-    for f in fileList
+    (f, f.with_stem(slug) if isFile else f.with_name(slug))
+    for (f, isFile), slug in zip(fileList, slugs)
 ]
 
 
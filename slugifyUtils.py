@@ -0,0 +1,205 @@
+"""
+Shared slugify for chapterSplitsM4a.py, chapterizeAudio.py and slugifyNames.py,
+run it directly to benchmark it against the old per-script version.
+"""
+
+import argparse
+import random
+import re
+import time
+from functools import lru_cache
+from unicodedata import normalize
+
+# \w word characters/alphanumerics, \s whitespace characters,
+# underscores, parentheses, and hyphens (and dots with keepDots)
+rejectPatterns = {
+    False: re.compile(r"[^\w\s)(_-]+"),
+    True: re.compile(r"[^\w\s.)(_-]+"),
+}
+
+spacePattern = re.compile(r"\s+")
+
+hyphenPattern = re.compile(r"[-\s]+")
+
+defaultSwap = {"[": "(", "]": ")"}
+
+cacheSize = 1 << 16
+
+
+@lru_cache(maxsize=None)
+def getSwapTables(swap):
+    """
+    Single character swaps are done in one translate pass, longer ones with
+    str.replace after it. str.translate looks every character up in a dict,
+    so ascii names use a bytes table when the swaps are ascii one to one,
+    which is several times faster.
+    """
+    swap = {**defaultSwap, **dict(swap)}
+    chars = {k: v for k, v in swap.items() if len(k) == 1}
+    multi = tuple((k, v) for k, v in swap.items() if len(k) != 1)
+    strTable = str.maketrans(chars)
+    if all(len(v) == 1 and f"{k}{v}".isascii() for k, v in chars.items()):
+        keys, values = "".join(chars.keys()), "".join(chars.values())
+        return bytes.maketrans(keys.encode(), values.encode()), strTable, multi
+    return None, strTable, multi
+
+
+def slugifyOne(
+    value, allowUnicode, replace, keepSpace, keepDots, lowerCase, collapseSpace, swap
+):
+    bytesTable, strTable, multi = getSwapTables(swap)
+
+    # NFKC/NFKD are no-ops for plain ascii names
+    if allowUnicode:
+        if not value.isascii():
+            value = normalize("NFKC", value)
+        value = value.translate(strTable)
+    else:
+        if not value.isascii():
+            value = normalize("NFKD", value)
+        value = value.encode("ascii", "ignore")
+        if bytesTable:
+            value = value.translate(bytesTable).decode("ascii")
+        else:
+            value = value.decode("ascii").translate(strTable)
+
+    for k, v in multi:
+        value = value.replace(k, v)
+
+    value = rejectPatterns[keepDots].sub("_" if replace else "", value).strip()
+
+    if lowerCase:
+        value = value.lower()
+
+    if not keepSpace:
+        value = hyphenPattern.sub("-", value)
+    elif collapseSpace:
+        value = spacePattern.sub(" ", value)
+
+    return value
+
+
+slugifyCached = lru_cache(maxsize=cacheSize)(slugifyOne)
+
+
+def slugify(
+    value,
+    allowUnicode=False,
+    replace=True,
+    keepSpace=True,
+    keepDots=True,
+    lowerCase=False,
+    collapseSpace=False,
+    swap=None,
+):
+    """
+    Adapted from django.utils.text.slugify
+    https://docs.djangoproject.com/en/3.0/_modules/django/utils/text/#slugify
+    """
+    return slugifyCached(
+        str(value),
+        allowUnicode,
+        replace,
+        keepSpace,
+        keepDots,
+        lowerCase,
+        collapseSpace,
+        tuple(swap.items()) if swap else (),
+    )
+
+
+def slugifyBatch(
+    values,
+    allowUnicode=False,
+    replace=True,
+    keepSpace=True,
+    keepDots=True,
+    lowerCase=False,
+    collapseSpace=False,
+    swap=None,
+):
+    """
+    slugify a list of names, repeated names are only processed once and the
+    shared LRU cache isn't churned by one off names.
+    """
+    options = (
+        allowUnicode,
+        replace,
+        keepSpace,
+        keepDots,
+        lowerCase,
+        collapseSpace,
+        tuple(swap.items()) if swap else (),
+    )
+    seen = {}
+    slugs = []
+    for value in values:
+        value = str(value)
+        slug = seen.get(value)
+        if slug is None:
+            slug = seen[value] = slugifyOne(value, *options)
+        slugs.append(slug)
+    return slugs
+
+
+def legacySlugify(value, replace=True, keepDots=True, swap={}):
+    # slugifyNames.py before the shared module, kept for the benchmark
+    value = normalize("NFKD", str(value)).encode("ascii", "ignore").decode("ascii")
+    swap = {"[": "(", "]": ")", **swap}
+    for k, v in swap.items():
+        value = value.replace(k, v)
+    rejectPattern = r"[^\w\s)(_-]+"
+    if keepDots:
+        rejectPattern = rejectPattern.replace(r"\s", r"\s.")
+    return re.sub(rejectPattern, "_" if replace else "", value).strip()
+
+
+def getNames(count, seed=0):
+    # Album/track style names with accents, brackets and punctuation, about
+    # half of them repeat like they would across a music library.
+    rnd = random.Random(seed)
+    words = (
+        "The Love Night Song Live Remix feat. Café Señor Über Straße naïve "
+        "Björk Sigur Rós Motörhead Déjà vu Part Vol. Intro Outro Acoustic "
+        "Edit (Remastered) [Bonus] & Friends: Episode #1 L'amour d'été"
+    ).split()
+    names = []
+    for _ in range(count):
+        if names and rnd.random() < 0.5:
+            names.append(rnd.choice(names))
+            continue
+        title = " ".join(rnd.choices(words, k=rnd.randint(2, 7)))
+        names.append(f"{rnd.randint(1, 30):02d} - {title}{rnd.choice(['', ' ', '!'])}")
+    return names
+
+
+def runBenchmark(count):
+    names = getNames(count)
+    print(f"\n{count} names, {len(set(names))} unique")
+
+    for label, run in (
+        ("legacy", lambda: [legacySlugify(n) for n in names]),
+        ("slugify", lambda: [slugify(n) for n in names]),
+        ("slugifyBatch", lambda: slugifyBatch(names)),
+    ):
+        slugifyCached.cache_clear()
+        start = time.perf_counter()
+        slugs = run()
+        elapsed = time.perf_counter() - start
+        print(f"{label:>14}: {elapsed:.2f}s, {count / elapsed:,.0f} names/s")
+        if label == "legacy":
+            expected = slugs
+        elif slugs != expected:
+            print(f"{label:>14}: output differs from legacy")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark slugify.")
+    parser.add_argument(
+        "-n",
+        "--count",
+        default=1_000_000,
+        type=int,
+        help="Number of file names to slugify, default is 1000000",
+    )
+    runBenchmark(parser.parse_args().count)